@@ -0,0 +1,272 @@
+"""Bulk administration of many queues at once.
+
+Pipelines create a "queue::tool" sub-queue (and possibly shards) per tool, so
+tearing down a run touches hundreds of queues. These functions select queues
+by name prefix and work on them together: RabbitMQ queues are listed (and
+counted) with a single management API request, and per-queue calls to
+RabbitMQ or SQS run concurrently.
+
+Example:
+    admin.count_queues("amqp://localhost:5672", prefix="myrun::")
+    admin.delete_queues("amqp://localhost:5672", prefix="myrun::")
+"""
+from __future__ import annotations
+
+import os
+import contextlib
+from urllib.parse import quote, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator
+
+import requests
+from kombu.transport import memory
+
+from . import sqlite
+from . import queuetools as qt
+
+
+MAX_WORKERS = 16  # concurrent requests to the broker
+
+
+def list_queues(
+    queue_url: str,
+    prefix: str = "",
+    username: str = "guest",
+    password: str = "guest",
+) -> list[str]:
+    """Lists the queues whose names start with a prefix.
+
+    SQS queues are listed by their SQS names (see kombu's
+    Channel.canonical_queue_name). Memory, filesystem and SQLite queues are
+    only listed while they hold messages.
+    """
+    if queue_url.startswith("amqp://"):
+        return sorted(_rabbitmq_queues(queue_url, prefix, username, password))
+
+    elif queue_url.startswith("sqs://"):
+        with _sqs_client(queue_url) as (client, channel):
+            return sorted(_sqs_queue_urls(client, channel, prefix))
+
+    elif queue_url.startswith(qt.LOCAL_SCHEMES):
+        return sorted(_local_queue_sizes(queue_url, prefix))
+
+    else:
+        raise ValueError(f"unrecognized queue url: {queue_url}")
+
+
+def count_queues(
+    queue_url: str,
+    prefix: str = "",
+    username: str = "guest",
+    password: str = "guest",
+    max_workers: int = MAX_WORKERS,
+) -> dict[str, int]:
+    """Counts the messages of every queue whose name starts with a prefix.
+
+    Like queuetools.num_msgs, this includes un-acked messages where the
+    backend tracks them.
+    """
+    if queue_url.startswith("amqp://"):
+        return _rabbitmq_queues(queue_url, prefix, username, password)
+
+    elif queue_url.startswith("sqs://"):
+        with _sqs_client(queue_url) as (client, channel):
+            urls = _sqs_queue_urls(client, channel, prefix)
+
+            def count(name: str) -> int:
+                attributes = client.get_queue_attributes(
+                    QueueUrl=urls[name],
+                    AttributeNames=[
+                        "ApproximateNumberOfMessages",
+                        "ApproximateNumberOfMessagesNotVisible",
+                    ],
+                )["Attributes"]
+                return int(attributes["ApproximateNumberOfMessages"]) + int(
+                    attributes["ApproximateNumberOfMessagesNotVisible"]
+                )
+
+            return _map_concurrently(count, urls, max_workers)
+
+    elif queue_url.startswith(qt.LOCAL_SCHEMES):
+        return _local_queue_sizes(queue_url, prefix)
+
+    else:
+        raise ValueError(f"unrecognized queue url: {queue_url}")
+
+
+def purge_queues(
+    queue_url: str,
+    prefix: str,
+    username: str = "guest",
+    password: str = "guest",
+    max_workers: int = MAX_WORKERS,
+) -> list[str]:
+    """Removes all messages from every queue whose name starts with a prefix.
+
+    Returns:
+        The names of the purged queues.
+
+    Raises:
+        ValueError: if the prefix is empty (which would match every queue).
+    """
+    return _apply(queue_url, prefix, username, password, max_workers, delete=False)
+
+
+def delete_queues(
+    queue_url: str,
+    prefix: str,
+    username: str = "guest",
+    password: str = "guest",
+    max_workers: int = MAX_WORKERS,
+) -> list[str]:
+    """Deletes every queue whose name starts with a prefix.
+
+    Returns:
+        The names of the deleted queues.
+
+    Raises:
+        ValueError: if the prefix is empty (which would match every queue).
+    """
+    return _apply(queue_url, prefix, username, password, max_workers, delete=True)
+
+
+def _apply(
+    queue_url: str,
+    prefix: str,
+    username: str,
+    password: str,
+    max_workers: int,
+    delete: bool,
+) -> list[str]:
+    """Purges or deletes every queue whose name starts with a prefix."""
+    if not prefix:
+        raise ValueError("a non-empty prefix is required to purge or delete queues")
+
+    if queue_url.startswith("amqp://"):
+        api_url = _rabbitmq_api_url(queue_url)
+        names = list(_rabbitmq_queues(queue_url, prefix, username, password))
+
+        def request(name: str) -> None:
+            url = f"{api_url}/queues/%2f/{quote(name, safe='')}"
+            ret = requests.delete(
+                url if delete else f"{url}/contents", auth=(username, password)
+            )
+            if not ret.ok and ret.status_code != 404:
+                raise RuntimeError(f"Cannot remove {name} through rabbitmq: {ret.text}")
+
+        _map_concurrently(request, names, max_workers)
+        return sorted(names)
+
+    elif queue_url.startswith("sqs://"):
+        with _sqs_client(queue_url) as (client, channel):
+            urls = _sqs_queue_urls(client, channel, prefix)
+
+            def call(name: str) -> None:
+                if delete:
+                    client.delete_queue(QueueUrl=urls[name])
+                else:
+                    client.purge_queue(QueueUrl=urls[name])
+
+            _map_concurrently(call, urls, max_workers)
+            return sorted(urls)
+
+    elif queue_url.startswith(qt.LOCAL_SCHEMES):
+        # local queues are cheap to reach, so one connection does them all
+        names = list(_local_queue_sizes(queue_url, prefix))
+        with qt.connect(queue_url) as conn:
+            channel = conn.default_channel
+            for name in names:
+                if delete:
+                    channel.queue_delete(name)
+                else:
+                    channel.queue_purge(name)
+
+        return sorted(names)
+
+    else:
+        raise ValueError(f"unrecognized queue url: {queue_url}")
+
+
+def _map_concurrently(
+    fn: Callable[[str], Any], keys: Iterable[str], max_workers: int
+) -> dict[str, Any]:
+    """Calls fn on each key concurrently, re-raising the first error."""
+    keys = list(keys)
+    if len(keys) == 0:
+        return dict()
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        return dict(zip(keys, executor.map(fn, keys)))
+
+
+def _rabbitmq_api_url(queue_url: str) -> str:
+    rq_host = urlparse(queue_url).netloc.split(":")[0]
+    return f"http://{rq_host}:15672/api"
+
+
+def _rabbitmq_queues(
+    queue_url: str, prefix: str, username: str, password: str
+) -> dict[str, int]:
+    """Lists RabbitMQ queues and their sizes with a single request."""
+    ret = requests.get(
+        f"{_rabbitmq_api_url(queue_url)}/queues/%2f",
+        params=dict(columns="name,messages"),
+        auth=(username, password),
+    )
+
+    if not ret.ok:
+        raise RuntimeError("Cannot list queues from rabbitmq management interface")
+
+    return {
+        queue["name"]: int(queue.get("messages") or 0)
+        for queue in ret.json()
+        if queue["name"].startswith(prefix)
+    }
+
+
+@contextlib.contextmanager
+def _sqs_client(queue_url: str) -> Iterator[tuple[Any, Any]]:
+    """Opens a boto SQS client through kombu's connection settings."""
+    with qt.connect(queue_url) as conn:
+        channel = conn.default_channel
+        yield channel.sqs(), channel
+
+
+def _sqs_queue_urls(client: Any, channel: Any, prefix: str) -> dict[str, str]:
+    """Maps SQS queue names that start with a prefix to their urls."""
+    kwargs = dict(QueueNamePrefix=channel.canonical_queue_name(prefix))
+
+    urls = dict()
+    while True:
+        resp = client.list_queues(MaxResults=1000, **kwargs)
+        for url in resp.get("QueueUrls", []):
+            urls[url.rstrip("/").rsplit("/", 1)[-1]] = url
+
+        if "NextToken" not in resp:
+            return urls
+        kwargs["NextToken"] = resp["NextToken"]
+
+
+def _local_queue_sizes(queue_url: str, prefix: str) -> dict[str, int]:
+    """Counts the messages of local queues that start with a prefix."""
+    if queue_url.startswith("sqlite://"):
+        return sqlite.queue_sizes(qt.local_path(queue_url), prefix)
+
+    if queue_url.startswith("memory://"):
+        names = list(memory.Channel.queues)
+
+    else:  # filesystem, where messages are named "{time}_{uuid}.{queue}.msg"
+        data_folder = os.path.join(qt.local_path(queue_url), "data")
+        filenames = os.listdir(data_folder) if os.path.isdir(data_folder) else []
+        names = [
+            filename.split(".", 1)[1][: -len(".msg")]
+            for filename in filenames
+            if filename.endswith(".msg")
+        ]
+
+    sizes = dict()
+    for name in set(names):
+        if name.startswith(prefix):
+            sizes[name] = qt.num_msgs_local(queue_url, name)
+
+    return {name: size for name, size in sizes.items() if size > 0}
@@ -2,12 +2,29 @@
 from __future__ import annotations
 
 import sys
-import json
 import time
+import zlib
+import uuid
 import signal
+import functools
+import socket
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from types import SimpleNamespace
-from typing import Optional, Callable, Iterable, Any
-
+from typing import Optional, Callable, ContextManager, Iterable, Any
+
+import kombu
+
+from . import codec
+from . import dag
+from . import capture
+from . import checkpoints
+from . import dedup
+from . import introspect
+from . import recycling
+from . import limits
+from . import results
 from . import queuetools as qt
 from .log import logger
 
@@ -27,13 +44,49 @@ def parse_queue(
     return q
 
 
+def shard_queue(queue_name: str, shard: int) -> str:
+    """Names a shard of a (tool-specific) sub-queue."""
+    return f"{queue_name}::shard{shard}"
+
+
+def affinity_shard(affinity_key: Any, num_shards: int) -> int:
+    """Maps an affinity key to a shard (consistently across processes)."""
+    return zlib.crc32(str(affinity_key).encode()) % num_shards
+
+
+def home_shards(
+    queue_name: str, num_shards: int, home_shard: Optional[int] = None
+) -> list[str]:
+    """Orders the queues of a sharded sub-queue by a worker's preference.
+
+    Workers prefer their home shard (by default picked by hostname, so workers
+    on a node share their local caches), then unsharded tasks, and only then
+    steal from other shards.
+    """
+    if home_shard is None:
+        home_shard = affinity_shard(socket.gethostname(), num_shards)
+
+    others = [(home_shard + i) % num_shards for i in range(1, num_shards)]
+
+    return (
+        [shard_queue(queue_name, home_shard), queue_name]
+        + [shard_queue(queue_name, shard) for shard in others]
+    )
+
+
 def purge_queue(
-    queue_url: str, tool_name: str, queue_name: Optional[str] = None
+    queue_url: str,
+    tool_name: str,
+    queue_name: Optional[str] = None,
+    num_shards: int = 1,
 ) -> None:
-    """Purges a tool-specific sub-queue."""
+    """Purges a tool-specific sub-queue (and its shards)."""
     q = parse_queue(queue_url, tool_name, queue_name)
 
     qt.purge_queue(q.url, q.name)
+    if num_shards > 1:
+        for shard in range(num_shards):
+            qt.purge_queue(q.url, shard_queue(q.name, shard))
 
 
 def insert_task(
@@ -42,9 +95,13 @@ def insert_task(
     *args: Any,
     queue_name: str = None,
     **kwargs: Any,
-) -> None:
-    """Submits a single task to the desired queue."""
-    insert_tasks(queue_url, tool_name, [args], [kwargs], queue_name=queue_name)
+) -> str:
+    """Submits a single task to the desired queue and returns its ID."""
+    (task_id,) = insert_tasks(
+        queue_url, tool_name, [args], [kwargs], queue_name=queue_name
+    )
+
+    return task_id
 
 
 def insert_tasks(
@@ -53,21 +110,134 @@ def insert_tasks(
     task_args: list[Iterable],
     task_kwargs: list[dict],
     queue_name: str = None,
-) -> None:
-    """Submits a set of tasks to the desired queue.
-
-    Lengths of task_args and task_kwargs must match.
+    affinity_keys: Optional[list[Any]] = None,
+    num_shards: int = 1,
+    delay: Optional[float] = None,
+    not_before: Optional[float] = None,
+    dedup_index: Optional[dedup.Index] = None,
+    parents: Optional[list[Iterable[str]]] = None,
+    dag_store: Optional[dag.Store] = None,
+    raw_json: bool = False,
+) -> list[str]:
+    """Submits a set of tasks to the desired queue and returns their IDs.
+
+    Lengths of task_args and task_kwargs must match. Tasks with affinity_keys
+    are routed to one of num_shards shards of the sub-queue by key, so tasks
+    sharing a key (e.g., neighboring chunks) are preferably run by the same
+    workers (see poll).
+
+    Delivery can be postponed by delay seconds, or until the not_before unix
+    timestamp (see queuetools.insert_msgs).
+
+    With a dedup_index, tasks whose args and kwargs match a task that's still
+    pending aren't submitted again, and the pending task's ID is returned in
+    their place (see dedup.Index).
+
+    Tasks can depend on the IDs of earlier tasks through parents (one list of
+    IDs per task). Tasks with unfinished parents are held in the dag_store,
+    and published (without any delay) once workers polling with the same
+    store complete their parents (see dag.release).
+
+    Plain payloads are JSON strings serialized by kombu, which every worker
+    version can read. With raw_json, they're published as raw JSON bodies
+    that newer workers parse only once (see codec). Payloads with binary
+    fields always use the framed format.
     """
     assert len(task_args) == len(task_kwargs), "mismatched task_args & task_kwargs"
+    if affinity_keys is not None:
+        assert len(affinity_keys) == len(task_args), "mismatched tasks & affinity_keys"
+    if parents is not None:
+        assert len(parents) == len(task_args), "mismatched tasks & parents"
+        assert dag_store is not None, "tasks with parents need a dag_store"
 
     q = parse_queue(queue_url, tool_name, queue_name)
 
-    packed = [
-        json.dumps(dict(args=args, kwargs=kwargs))
-        for (args, kwargs) in zip(task_args, task_kwargs)
+    task_ids = [uuid.uuid4().hex for _ in task_args]
+    payloads: list[dict[str, Any]] = [
+        dict(id=task_id, args=args, kwargs=kwargs)
+        for (task_id, args, kwargs) in zip(task_ids, task_args, task_kwargs)
     ]
+    keys: list = [None] * len(payloads)
+
+    if dedup_index is not None:
+        keys = [
+            dedup.payload_key(dict(args=args, kwargs=kwargs))
+            for (args, kwargs) in zip(task_args, task_kwargs)
+        ]
+        pending = dedup_index.submit(keys, task_ids)
+
+        task_ids = [
+            pending_id or task_id for (pending_id, task_id) in zip(pending, task_ids)
+        ]
+        new = [i for (i, pending_id) in enumerate(pending) if pending_id is None]
+        payloads = [dict(payloads[i], dedup=keys[i]) for i in new]
+        keys = [keys[i] for i in new]
+        if affinity_keys is not None:
+            affinity_keys = [affinity_keys[i] for i in new]
+        if parents is not None:
+            parents = [parents[i] for i in new]
+
+    packed, content_type = codec.encode(payloads, legacy=not raw_json)
+    dedup_ids = keys if dedup_index is not None else None
+
+    if not_before is not None:
+        delay = max(not_before - time.time(), 0)
+
+    if affinity_keys is None or num_shards == 1:
+        destinations = [q.name] * len(packed)
+    else:
+        destinations = [
+            shard_queue(q.name, affinity_shard(affinity_key, num_shards))
+            for affinity_key in affinity_keys
+        ]
+
+    try:
+        batches = defaultdict(list)
+        for (i, (body, key, destination)) in enumerate(
+            zip(packed, keys, destinations)
+        ):
+            if parents is not None and dag_store is not None:
+                task_id = payloads[i]["id"]
+                held = dag.HeldTask(task_id, q.url, destination, body, content_type)
+                if dag_store.hold(held, parents[i]):
+                    continue
+
+            batches[destination].append((body, key))
+
+        for (destination, entries) in batches.items():
+            qt.insert_msgs(
+                q.url,
+                destination,
+                [body for (body, _) in entries],
+                content_type=content_type,
+                delay=delay,
+                dedup_ids=None if dedup_ids is None else [key for (_, key) in entries],
+            )
+    except Exception:
+        # forgets the keys of tasks that may not have been published
+        if dedup_index is not None:
+            dedup_index.discard(keys)
+        raise
 
-    qt.insert_msgs(q.url, q.name, packed)
+    return task_ids
+
+
+def aggregate(
+    queue_url: str,
+    tool_name: str,
+    task_ids: Optional[Iterable[str]] = None,
+    queue_name: Optional[str] = None,
+    poll_interval: float = 1.0,
+) -> results.Aggregator:
+    """Creates an aggregator for the results published by a tool's workers.
+
+    See poll's publish_results argument and results.Aggregator.
+    """
+    q = parse_queue(queue_url, tool_name, queue_name)
+
+    return results.Aggregator(
+        q.url, results.results_queue(q.name), task_ids, poll_interval=poll_interval
+    )
 
 
 def poll(
@@ -79,26 +249,93 @@ def poll(
     max_waiting_period: int = 60,
     max_num_retries: int = 5,
     verbose: bool = False,
-) -> None:
+    copy_buffers: bool = False,
+    ack_batch_size: int = 1,
+    ack_interval: float = 1.0,
+    publish_results: bool = False,
+    results_batch_size: int = 1,
+    results_interval: float = 1.0,
+    rate_limit: Optional[float] = None,
+    rate_burst: int = 1,
+    max_concurrent: Optional[int] = None,
+    limit_dir: Optional[str] = None,
+    num_shards: int = 1,
+    home_shard: Optional[int] = None,
+    checkpoint_store: Optional[checkpoints.Store] = None,
+    introspect_address: Optional[str] = None,
+    max_tasks: Optional[int] = None,
+    max_rss_mb: Optional[float] = None,
+    max_wall_time: Optional[float] = None,
+    capture_path: Optional[str] = None,
+    dedup_index: Optional[dedup.Index] = None,
+    dag_store: Optional[dag.Store] = None,
+    pipeline: bool = False,
+) -> Optional[str]:
     """Fetches tasks and executes them.
 
     Fetches messages from the queue. Parses them using the (tool-defined) parser
-    to create tasks, and executes those tasks.
+    to create tasks, and executes those tasks. Setup that repeats across tasks
+    within the parser can be cached with memo.memoize. Binary task arguments
+    (bytes or numpy arrays) are passed as read-only views into the message
+    body unless copy_buffers is set. Setting ack_batch_size above 1 coalesces
+    acks (see queuetools.fetch_msgs).
+
+    With publish_results, each task's return value (or failure) is published
+    to a results sub-queue in batches of up to results_batch_size records.
+    These can be consumed by the aggregator returned by aggregate.
+
+    Task execution can be limited to rate_limit tasks per second (allowing
+    bursts of rate_burst) and to max_concurrent tasks at a time for this
+    sub-queue. Limits are shared by all workers of this process, and by all
+    workers on the node that use the same limit_dir (see limits.Limiter).
+
+    For sub-queues split into num_shards shards by insert_tasks, the worker
+    takes tasks from its home shard first and only steals from the others
+    while its own shard is empty (see home_shards).
+
+    With a checkpoint_store, tasks can save their progress through
+    checkpoints.current() and resume from it if they're redelivered.
+
+    With an introspect_address ("host:port" or a Unix socket path), the
+    worker serves its live state and thread stacks (see introspect.serve).
+
+    The worker stops after max_tasks tasks, once its RSS exceeds max_rss_mb
+    (checked between tasks), or once max_wall_time seconds pass (even while
+    the queue is empty), always after acking its current task (see
+    recycling.supervise to replace it).
+
+    With a capture_path, the fetched messages and their fetch and ack times
+    are appended to a capture file for replay (see capture.replay).
+
+    Completed tasks are removed from the dedup_index that they were inserted
+    with, so they can be submitted again. With a dag_store, completing a task
+    publishes the children that were only waiting for it, and tasks that the
+    store already records as completed are skipped (see dag.release).
+
+    Parsers can return two-phase tasks: objects with a prepare method (e.g.,
+    to fetch inputs) and a run method (e.g., to compute). With pipeline set,
+    the worker fetches the next message and prepares its task in a background
+    thread while the current task runs. Messages are still acked in order,
+    once their task runs successfully. Both phases run under the limits and
+    the task's checkpoint, with the rate limit applied once, to prepare.
+
+    Returns:
+        Why the worker was recycled, or None if it stopped for another reason.
     """
     q = parse_queue(queue_url, tool_name, queue_name)
 
-    global KEEP_LOOPING
-    KEEP_LOOPING = True  # type: ignore[name-defined]
+    # per call, so workers can poll in several threads of one process
+    keep_looping = threading.Event()
+    keep_looping.set()
 
     def siginthandler(signum, frame):
-        global KEEP_LOOPING
-        if KEEP_LOOPING:
+        if keep_looping.is_set():
             logger.info(
                 "Interrupted w/ SIGINT."
                 " Exiting after this task completes."
                 " Interrupt again to exit now.",
             )
-            KEEP_LOOPING = False
+            keep_looping.clear()
         else:
             sys.exit()
 
@@ -106,41 +343,310 @@ def poll(
         logger.info("Interrupted w/ SIGTERM. Exiting now.")
         sys.exit()
 
-    prev_siginthandler = signal.getsignal(signal.SIGINT)
-    signal.signal(signal.SIGINT, siginthandler)
+    # signal handlers can only be installed from the main thread
+    handle_signals = threading.current_thread() is threading.main_thread()
+    if handle_signals:
+        prev_siginthandler = signal.getsignal(signal.SIGINT)
+        signal.signal(signal.SIGINT, siginthandler)
 
-    prev_sigtermhandler = signal.getsignal(signal.SIGTERM)
-    signal.signal(signal.SIGTERM, sigtermhandler)
+        prev_sigtermhandler = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, sigtermhandler)
 
-    it = qt.fetch_msgs(
-        q.url,
-        q.name,
-        init_waiting_period=init_waiting_period,
-        max_waiting_period=max_waiting_period,
-        max_num_retries=max_num_retries,
-        verbose=verbose,
+    queue_names = [q.name]
+    if num_shards > 1:
+        queue_names = home_shards(q.name, num_shards, home_shard)
+
+    policy = recycling.RecyclePolicy(
+        max_tasks=max_tasks, max_rss_mb=max_rss_mb, max_wall_time=max_wall_time
     )
+    recycle_reason = None
+
+    status = introspect.Status(q.name)
+    server = None
+    recorder = None
+    consumer = None
+    publisher = None
+    prefetcher = None
+    try:
+        if introspect_address is not None:
+            server = introspect.serve(introspect_address)
+
+        recorder = None if capture_path is None else capture.Recorder(capture_path)
+
+        consumer = qt.Consumer(
+            q.url,
+            queue_names[0],
+            init_waiting_period=init_waiting_period,
+            max_waiting_period=max_waiting_period,
+            max_num_retries=max_num_retries,
+            verbose=verbose,
+            ack_batch_size=ack_batch_size,
+            ack_interval=ack_interval,
+            steal_from=queue_names[1:],
+            status=status,
+            recorder=recorder,
+            prefetch=2 if pipeline else 1,
+            # lets an idle worker recycle once max_wall_time passes
+            stop_when=lambda: policy.expired() is not None,
+        )
+        it = iter(consumer)
+
+        limiter = limits.get_limiter(
+            q.name,
+            rate=rate_limit,
+            burst=rate_burst,
+            max_concurrent=max_concurrent,
+            lock_dir=limit_dir,
+        )
+
+        if publish_results:
+            publisher = results.ResultPublisher(
+                q.url,
+                results.results_queue(q.name),
+                batch_size=results_batch_size,
+                interval=results_interval,
+            )
 
-    while KEEP_LOOPING:  # type: ignore[name-defined]
-        try:
-            msg = next(it)
-            parsed = json.loads(msg.payload)
-            args, kwargs = parsed["args"], parsed["kwargs"]
+        hooks = _TaskHooks(
+            consumer,
+            publisher=publisher,
+            checkpoint_store=checkpoint_store,
+            dedup_index=dedup_index,
+            dag_store=dag_store,
+        )
+        prepare = functools.partial(
+            _prepare_task,
+            task_parser=task_parser,
+            limiter=limiter,
+            hooks=hooks,
+            copy_buffers=copy_buffers,
+        )
+        if pipeline:
+            prefetcher = _Prefetcher(consumer, prepare)
+
+        while keep_looping.is_set():
+            try:
+                prefetched = None if prefetcher is None else prefetcher.take()
+                msg, parsed, task, task_exc = prefetched or prepare(next(it))
+                task_id = parsed.get("id")
+
+                if hooks.is_duplicate(task_id):
+                    hooks.skip(msg, task_id)
+                    continue
+
+                if prefetcher is not None:
+                    prefetcher.start()
+
+                status.start_task(task_id or str(msg.delivery_tag))
+
+                start_time = time.time()
+                try:
+                    if task_exc is not None:
+                        raise task_exc
+
+                    result = _run_task(task, limiter, hooks.checkpoint(msg))
+                except Exception as exc:
+                    hooks.fail(task_id, exc)
+
+                    # releases the message for redelivery (keeping its checkpoint)
+                    raise
+                finally:
+                    if prefetcher is not None:
+                        prefetcher.stop()
+                elapsed = time.time() - start_time
+
+                hooks.succeed(msg, parsed, result, elapsed)
+                status.finish_task()
+                logger.info(f"Task successfully executed in {elapsed:.2f}s")
+
+                recycle_reason = policy.task_done()
+                if recycle_reason is not None:
+                    logger.info(f"Recycling worker: {recycle_reason}")
+                    break
+
+            except StopIteration:
+                recycle_reason = policy.expired()
+                break
+    finally:
+        # also when fetching, running or completing a task fails
+        if prefetcher is not None:
+            # the consumer can't close while the prefetcher is using it
+            prefetcher.close()
+
+        if handle_signals:
+            signal.signal(signal.SIGINT, prev_siginthandler)
+            signal.signal(signal.SIGTERM, prev_sigtermhandler)
+
+        if publisher is not None:
+            publisher.close()
+        if consumer is not None:
+            consumer.close()
+        status.close()
+        if server is not None:
+            introspect.stop(server)
+        if recorder is not None:
+            recorder.close()
+
+    return recycle_reason
+
+
+class _TaskHooks:
+    """Applies poll's optional features as each task runs and completes."""
+
+    def __init__(
+        self,
+        consumer: qt.Consumer,
+        publisher: Optional[results.ResultPublisher] = None,
+        checkpoint_store: Optional[checkpoints.Store] = None,
+        dedup_index: Optional[dedup.Index] = None,
+        dag_store: Optional[dag.Store] = None,
+    ):
+        self.consumer = consumer
+        self.publisher = publisher
+        self.checkpoint_store = checkpoint_store
+        self.dedup_index = dedup_index
+        self.dag_store = dag_store
+
+    def checkpoint(self, msg: kombu.Message) -> ContextManager:
+        """Makes the task's checkpoint available (see checkpoints.activate)."""
+        return checkpoints.activate(self.checkpoint_store, msg)
+
+    def is_duplicate(self, task_id: Optional[str]) -> bool:
+        """Checks whether a task was already completed.
+
+        Children can be published twice (see dag.release).
+        """
+        return (
+            self.dag_store is not None
+            and task_id is not None
+            and self.dag_store.is_complete(task_id)
+        )
+
+    def skip(self, msg: kombu.Message, task_id: str) -> None:
+        """Acks a duplicate task without running it."""
+        logger.info(f"Skipping completed task {task_id}")
+
+        # in case releasing its children was cut short
+        if self.dag_store is not None:
+            dag.release(self.dag_store, task_id)
+        self.consumer.ack(msg)
+
+    def fail(self, task_id: Optional[str], exc: Exception) -> None:
+        """Publishes a task's failure."""
+        if self.publisher is not None and task_id is not None:
+            self.publisher.add_failure(task_id, exc)
+
+    def succeed(
+        self, msg: kombu.Message, parsed: dict, result: Any, elapsed: float
+    ) -> None:
+        """Publishes a task's result, releases its children and acks it."""
+        task_id = parsed.get("id")
+        if self.publisher is not None and task_id is not None:
+            self.publisher.add_result(task_id, result, elapsed)
+
+        # before the ack, so a redelivered task releases its children again
+        if self.dag_store is not None and task_id is not None:
+            dag.release(self.dag_store, task_id)
+
+        self.consumer.ack(msg)
+        if self.checkpoint_store is not None:
+            self.checkpoint_store.delete(checkpoints.msg_key(msg))
+        if self.dedup_index is not None and "dedup" in parsed:
+            self.dedup_index.complete(parsed["dedup"])
+
+
+class _Prefetcher:
+    """Prepares the next task in a background thread while one runs.
+
+    It only waits for the fetch thread to hand off a message, never within
+    fetch_msgs' backoff, so the worker can stop as soon as its task finishes.
+    """
 
-            task = task_parser(*args, **kwargs)
+    def __init__(
+        self,
+        consumer: qt.Consumer,
+        prepare: Callable[[kombu.Message], tuple],
+        interval: float = 0.1,
+    ):
+        self.consumer = consumer
+        self.prepare = prepare
+        self.interval = interval
 
-            start_time = time.time()
-            task()
-            elapsed = time.time() - start_time
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._running = threading.Event()
+        self._upcoming: Optional[Future] = None
 
-            qt.ack_msg(msg)
-            logger.info(f"Task successfully executed in {elapsed:.2f}s")
+    def start(self) -> None:
+        """Starts waiting for the next message, while the current task runs."""
+        self._running.set()
+        self._upcoming = self._executor.submit(self._prefetch)
 
-        except StopIteration:
-            break
+    def stop(self) -> None:
+        """Stops waiting once the current task finishes."""
+        self._running.clear()
 
-    # Cleaning up in case fetch_msgs stops naturally
-    signal.signal(signal.SIGINT, prev_siginthandler)
-    signal.signal(signal.SIGTERM, prev_sigtermhandler)
+    def take(self) -> Optional[tuple]:
+        """Returns the next task if its message arrived in time (or None)."""
+        upcoming, self._upcoming = self._upcoming, None
 
-    it.close()
+        return None if upcoming is None else upcoming.result()
+
+    def close(self) -> None:
+        """Waits for the background thread to finish, and shuts it down."""
+        self.stop()
+        if self._upcoming is not None:
+            self._upcoming.exception()
+        self._executor.shutdown()
+
+    def _prefetch(self) -> Optional[tuple]:
+        while self._running.is_set():
+            msg = self.consumer.receive(timeout=self.interval)
+            if msg is not None:
+                return self.prepare(msg)
+
+        return None
+
+
+def _two_phase(task: Any) -> bool:
+    return hasattr(task, "prepare") and hasattr(task, "run")
+
+
+def _prepare_task(
+    msg: kombu.Message,
+    task_parser: Callable,
+    limiter: limits.Limiter,
+    hooks: _TaskHooks,
+    copy_buffers: bool = False,
+) -> tuple:
+    """Parses a message into a task, and prepares two-phase tasks.
+
+    Errors parsing or preparing the task are returned with its message, to be
+    raised when the task would run.
+
+    Returns:
+        The message, its parsed payload, the task and any error.
+    """
+    parsed: dict = dict()
+    task = None
+    try:
+        parsed = codec.decode(msg, copy=copy_buffers)
+        task = task_parser(*parsed["args"], **parsed["kwargs"])
+
+        if _two_phase(task):
+            with limiter, hooks.checkpoint(msg):
+                task.prepare()
+    except Exception as exc:
+        return msg, parsed, task, exc
+
+    return msg, parsed, task, None
+
+
+def _run_task(task: Any, limiter: limits.Limiter, checkpoint: ContextManager) -> Any:
+    """Runs a (prepared) task under the limits, within its checkpoint."""
+    if _two_phase(task):
+        # the rate limit was applied once, when it was prepared
+        with limiter.slot(), checkpoint:
+            return task.run()
+
+    with limiter, checkpoint:
+        return task()
@@ -0,0 +1,225 @@
+"""Capturing the message stream of a worker and replaying it offline.
+
+A Recorder appends every message fetched through fetch_msgs (its body and
+content type, with the time it was fetched) and the time it was acked to a
+compact append-only file. replay re-inserts a captured stream into a queue
+(e.g., a local one) at its original or an accelerated rate, so different
+worker versions can be benchmarked on identical workloads. Capturing the
+replayed run and comparing the two captures reports the differences in
+throughput and latency.
+
+Example:
+    ag.poll(queue_url, "mytool", task_parser, capture_path="prod.capture")
+    capture.replay("prod.capture", "sqlite:///tmp/bench.db", "bench::mytool")
+    ag.poll("sqlite:///tmp/bench.db", "mytool", task_parser,
+            queue_name="bench", capture_path="bench.capture")
+    capture.compare("prod.capture", "bench.capture")
+"""
+from __future__ import annotations
+
+import os
+import time
+import struct
+import threading
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional
+
+import kombu
+
+from . import queuetools as qt
+
+
+# Fetched messages remember their recorder and sequence number
+CAPTURE_ATTR = "_kombuworker_capture"
+
+# kind (b"F" fetch or b"A" ack), sequence number, timestamp,
+# and the lengths of the content type and body (fetches only)
+FETCH = b"F"
+ACK = b"A"
+RECORD_HEADER = struct.Struct("<cQdHI")
+
+
+@dataclass
+class CapturedMsg:
+    """A captured message and its fetch and ack times."""
+
+    body: bytes
+    content_type: Optional[str]
+    fetch_time: float
+    ack_time: Optional[float] = None
+
+    @property
+    def latency(self) -> Optional[float]:
+        """Seconds from fetching the message to acking it."""
+        return None if self.ack_time is None else self.ack_time - self.fetch_time
+
+
+class Recorder:
+    """Appends fetch and ack records to a capture file.
+
+    Records are written as they happen (and flushed), so a capture survives
+    the worker being killed. Several consumers may share a recorder.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        # continue the sequence of an existing capture
+        self._next_seq = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for _, seq, _, _ in _records(f):
+                    self._next_seq = max(self._next_seq, seq + 1)
+
+        self._file = open(path, "ab")
+
+    def record_fetch(self, msg: kombu.Message) -> None:
+        body = msg.body.encode() if isinstance(msg.body, str) else bytes(msg.body)
+        content_type = (msg.content_type or "").encode()
+
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._write(
+                RECORD_HEADER.pack(
+                    FETCH, seq, time.time(), len(content_type), len(body)
+                )
+                + content_type
+                + body
+            )
+
+        setattr(msg, CAPTURE_ATTR, (self, seq))
+
+    def record_ack(self, seq: int) -> None:
+        with self._lock:
+            self._write(RECORD_HEADER.pack(ACK, seq, time.time(), 0, 0))
+
+    def _write(self, record: bytes) -> None:
+        self._file.write(record)
+        self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def record_ack(msg: kombu.Message) -> None:
+    """Records the ack of a message if its fetch was captured."""
+    captured = getattr(msg, CAPTURE_ATTR, None)
+    if captured is not None:
+        recorder, seq = captured
+        recorder.record_ack(seq)
+
+
+def read(path: str) -> list[CapturedMsg]:
+    """Reads the messages of a capture file in the order they were fetched.
+
+    A file cut short by a crash is read up to its last complete record.
+    """
+    msgs: dict[int, CapturedMsg] = dict()
+
+    with open(path, "rb") as f:
+        for kind, seq, timestamp, body_info in _records(f):
+            if kind == FETCH:
+                content_type, body = body_info
+                msgs[seq] = CapturedMsg(body, content_type, timestamp)
+            elif seq in msgs:
+                msgs[seq].ack_time = timestamp
+
+    return sorted(msgs.values(), key=lambda msg: msg.fetch_time)
+
+
+def _records(f: Any) -> Iterator[tuple[bytes, int, float, tuple]]:
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+
+        kind, seq, timestamp, type_length, body_length = RECORD_HEADER.unpack(header)
+        content_type = f.read(type_length).decode()
+        body = f.read(body_length)
+        if len(body) < body_length:
+            return
+
+        yield kind, seq, timestamp, (content_type or None, body)
+
+
+def replay(
+    path: str,
+    queue_url: str,
+    queue_name: str,
+    speedup: Optional[float] = 1.0,
+) -> int:
+    """Re-inserts a captured stream into a queue, preserving its timing.
+
+    Messages are inserted at their original fetch times relative to the first
+    message, divided by speedup (or all at once if speedup is None).
+
+    Returns:
+        The number of messages inserted.
+    """
+    msgs = read(path)
+    if len(msgs) == 0:
+        return 0
+
+    start_time = time.time()
+    first_fetch = msgs[0].fetch_time
+
+    with qt.connect(queue_url) as conn:
+        queue = conn.SimpleQueue(queue_name)
+
+        for msg in msgs:
+            if speedup is not None:
+                due = start_time + (msg.fetch_time - first_fetch) / speedup
+                time.sleep(max(0.0, due - time.time()))
+
+            qt.submit_msg(queue, msg.body, content_type=msg.content_type)
+
+    return len(msgs)
+
+
+def summarize(msgs: list[CapturedMsg]) -> dict[str, float]:
+    """Computes the throughput and latency of a captured stream."""
+    ack_times = [msg.ack_time for msg in msgs if msg.ack_time is not None]
+    latencies = sorted(
+        msg.ack_time - msg.fetch_time for msg in msgs if msg.ack_time is not None
+    )
+    if len(latencies) == 0:
+        return dict(num_msgs=len(msgs), num_acked=0)
+
+    duration = max(ack_times) - min(msg.fetch_time for msg in msgs)
+
+    return dict(
+        num_msgs=len(msgs),
+        num_acked=len(latencies),
+        throughput=len(latencies) / duration if duration > 0 else float("inf"),
+        mean_latency=sum(latencies) / len(latencies),
+        p50_latency=_percentile(latencies, 0.5),
+        p95_latency=_percentile(latencies, 0.95),
+        max_latency=latencies[-1],
+    )
+
+
+def compare(baseline_path: str, candidate_path: str) -> dict[str, dict[str, float]]:
+    """Compares the throughput and latency of two captures.
+
+    Returns:
+        The summaries of both captures (see summarize), and the ratio of each
+        candidate statistic to the baseline's.
+    """
+    baseline = summarize(read(baseline_path))
+    candidate = summarize(read(candidate_path))
+
+    ratio = {
+        key: candidate[key] / baseline[key]
+        for key in baseline
+        if key in candidate and baseline[key] != 0
+    }
+
+    return dict(baseline=baseline, candidate=candidate, ratio=ratio)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[min(len(values) - 1, int(q * len(values)))]
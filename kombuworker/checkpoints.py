@@ -0,0 +1,169 @@
+"""Checkpoints that let redelivered tasks resume partial progress.
+
+When poll is given a checkpoint store, each task runs with a Checkpoint keyed
+by its message, available through current(). A task saves its progress as it
+goes, and loads it back when it's redelivered after a crash or preemption.
+Checkpoints are deleted once their task succeeds and its message is acked.
+
+Example:
+    def task():
+        checkpoint = checkpoints.current()
+        done = checkpoint.load(default=0)
+        for i in range(done, num_chunks):
+            process(i)
+            checkpoint.save(i + 1)
+"""
+from __future__ import annotations
+
+import os
+import abc
+import pickle
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import contextlib
+import contextvars
+from typing import Any, Iterator, Optional
+
+import kombu
+
+
+class Store(abc.ABC):
+    """Interface for checkpoint storage. States are stored as bytes."""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """Returns the state saved for a key, or None if there isn't one."""
+
+    @abc.abstractmethod
+    def put(self, key: str, state: bytes) -> None:
+        """Saves the state of a key, replacing any earlier one."""
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """Removes the state of a key, if it has one."""
+
+
+class DirectoryStore(Store):
+    """Stores checkpoints as files within a (local or shared) directory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.ckpt")
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._filename(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, state: bytes) -> None:
+        # write-then-rename so a crash never leaves a partial checkpoint
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(state)
+        os.replace(tmpname, self._filename(key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._filename(key))
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteStore(Store):
+    """Stores checkpoints within a SQLite database shared by local processes."""
+
+    def __init__(self, database: str, timeout: float = 60):
+        self.database = database
+        self._db = sqlite3.connect(
+            database, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints"
+            " (key TEXT PRIMARY KEY, state BLOB NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM checkpoints WHERE key = ?", (key,)
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+    def put(self, key: str, state: bytes) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints (key, state) VALUES (?, ?)",
+                (key, state),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM checkpoints WHERE key = ?", (key,))
+
+
+class Checkpoint:
+    """The saved progress of a single task."""
+
+    def __init__(self, store: Store, key: str):
+        self.store = store
+        self.key = key
+
+    def load(self, default: Any = None) -> Any:
+        """Returns the last saved state, or default if there isn't one."""
+        state = self.store.get(self.key)
+
+        return default if state is None else pickle.loads(state)
+
+    def save(self, state: Any) -> None:
+        """Replaces the saved state."""
+        self.store.put(self.key, pickle.dumps(state))
+
+    def clear(self) -> None:
+        self.store.delete(self.key)
+
+
+__CURRENT: contextvars.ContextVar = contextvars.ContextVar(
+    "kombuworker_checkpoint", default=None
+)
+
+
+def current() -> Optional[Checkpoint]:
+    """Returns the checkpoint of the running task (None if not checkpointed)."""
+    return __CURRENT.get()
+
+
+@contextlib.contextmanager
+def activate(
+    store: Optional[Store], msg: kombu.Message
+) -> Iterator[Optional[Checkpoint]]:
+    """Makes a message's checkpoint available through current().
+
+    Does nothing without a store.
+    """
+    if store is None:
+        yield None
+        return
+
+    checkpoint = Checkpoint(store, msg_key(msg))
+    token = __CURRENT.set(checkpoint)
+    try:
+        yield checkpoint
+    finally:
+        __CURRENT.reset(token)
+
+
+def msg_key(msg: kombu.Message) -> str:
+    """Identifies a message by its body, which is the same when redelivered."""
+    body = msg.body.encode() if isinstance(msg.body, str) else bytes(msg.body)
+
+    return hashlib.sha256(body).hexdigest()
@@ -0,0 +1,162 @@
+"""Message body encoding that avoids repeated decoding and copying.
+
+Task payloads can be published as raw JSON bodies (rather than JSON strings
+that kombu serializes a second time), so a worker parses each body exactly
+once. Workers from before this format call json.loads on the kombu-decoded
+payload and can't read raw bodies, so the legacy format stays the default of
+insert_tasks (see their raw_json argument). decode reads both formats.
+
+Payloads that contain binary fields (bytes or numpy arrays) use a simple
+framed format instead: a length-prefixed JSON header followed by the raw
+buffers. Decoding a framed body exposes those fields as read-only views into
+the message buffer without copying them.
+"""
+from __future__ import annotations
+
+import json
+import struct
+from typing import Any, Optional
+
+import kombu
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional
+    np = None  # type: ignore[assignment]
+
+
+JSON_CONTENT_TYPE = "application/json"
+FRAMES_CONTENT_TYPE = "application/x-kombuworker-frames"
+
+BUFFER_KEY = "__kombuworker_buffer__"
+HEADER_LENGTH = struct.Struct("<I")
+ALIGNMENT = 64  # byte alignment of each buffer within a framed body
+
+
+def encode(objs: list[Any], legacy: bool = False) -> tuple[list, Optional[str]]:
+    """Encodes a batch of payloads, returning their bodies and content type.
+
+    The framed format is only used when at least one payload has binary
+    fields, so plain payloads stay readable as JSON by other consumers. With
+    legacy set, plain payloads are returned as JSON strings (and no content
+    type) for kombu to serialize, as older workers expect.
+    """
+    buffers: list[list] = [list() for _ in objs]
+    headers = [_extract_buffers(obj, bufs) for (obj, bufs) in zip(objs, buffers)]
+
+    if not any(buffers):
+        if legacy:
+            return [json.dumps(obj) for obj in objs], None
+
+        return [json.dumps(obj).encode() for obj in objs], JSON_CONTENT_TYPE
+
+    return [_frame(h, bufs) for (h, bufs) in zip(headers, buffers)], (
+        FRAMES_CONTENT_TYPE
+    )
+
+
+def decode(msg: kombu.Message, copy: bool = False) -> Any:
+    """Parses a message body once, without decoding it to str first.
+
+    Args:
+        msg: A message fetched from the queue.
+        copy: Whether to copy binary fields out of the message buffer instead
+            of returning read-only views into it.
+    """
+    if msg.content_type == FRAMES_CONTENT_TYPE:
+        return _unframe(memoryview(msg.body), copy=copy)
+
+    elif msg.content_type == JSON_CONTENT_TYPE:
+        parsed = json.loads(msg.body)
+
+        # bodies submitted as str are serialized by kombu a second time
+        return json.loads(parsed) if isinstance(parsed, str) else parsed
+
+    else:
+        payload = msg.payload
+        return json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+
+
+def _extract_buffers(obj: Any, buffers: list) -> Any:
+    """Replaces binary fields with placeholders, collecting their buffers."""
+    if isinstance(obj, dict):
+        return {k: _extract_buffers(v, buffers) for (k, v) in obj.items()}
+
+    elif isinstance(obj, (list, tuple)):
+        return [_extract_buffers(v, buffers) for v in obj]
+
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        buffers.append(memoryview(obj).cast("B"))
+        return {BUFFER_KEY: len(buffers) - 1}
+
+    elif np is not None and isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        buffers.append(memoryview(arr.reshape(-1).view(np.uint8)))  # type: ignore
+        return {
+            BUFFER_KEY: len(buffers) - 1,
+            "dtype": arr.dtype.str,
+            "shape": list(arr.shape),
+        }
+
+    return obj
+
+
+def _frame(obj: Any, buffers: list[memoryview]) -> bytes:
+    """Lays out a header and its buffers within a single body."""
+    spans = list()
+    offset = 0
+    for buf in buffers:
+        spans.append([offset, buf.nbytes])
+        offset = _align(offset + buf.nbytes)
+
+    header = json.dumps(dict(obj=obj, spans=spans)).encode()
+    start = _align(HEADER_LENGTH.size + len(header))
+
+    parts: list = [HEADER_LENGTH.pack(len(header)), header]
+    position = HEADER_LENGTH.size + len(header)
+    for (buf, (buf_offset, _)) in zip(buffers, spans):
+        parts.append(bytes(start + buf_offset - position))
+        parts.append(buf)
+        position = start + buf_offset + buf.nbytes
+
+    return b"".join(parts)
+
+
+def _unframe(body: memoryview, copy: bool = False) -> Any:
+    (header_length,) = HEADER_LENGTH.unpack_from(body)
+    header_end = HEADER_LENGTH.size + header_length
+    header = json.loads(bytes(body[HEADER_LENGTH.size : header_end]))
+
+    start = _align(header_end)
+    buffers = [
+        body[start + offset : start + offset + nbytes]
+        for (offset, nbytes) in header["spans"]
+    ]
+
+    return _insert_buffers(header["obj"], buffers, copy)
+
+
+def _insert_buffers(obj: Any, buffers: list[memoryview], copy: bool) -> Any:
+    """Replaces placeholders with (views of) their buffers."""
+    if isinstance(obj, dict):
+        if BUFFER_KEY not in obj:
+            return {k: _insert_buffers(v, buffers, copy) for (k, v) in obj.items()}
+
+        buf = buffers[obj[BUFFER_KEY]]
+        if "dtype" not in obj:
+            return bytes(buf) if copy else buf
+
+        if np is None:
+            raise ImportError("numpy is required to decode array fields")
+
+        arr = np.frombuffer(buf, dtype=np.dtype(obj["dtype"])).reshape(obj["shape"])
+        return arr.copy() if copy else arr
+
+    elif isinstance(obj, list):
+        return [_insert_buffers(v, buffers, copy) for v in obj]
+
+    return obj
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
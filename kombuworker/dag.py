@@ -0,0 +1,220 @@
+"""Task dependency graphs that release downstream tasks as parents finish.
+
+Tasks inserted with parent task IDs are held in a Store instead of being
+published. Each parent that completes (as recorded by poll) decrements the
+number of unfinished parents of its children, and children that reach zero
+are published right away. Downstream stages then overlap with the tail of
+upstream ones, instead of waiting for a queue to drain.
+
+Example:
+    store = dag.SQLiteStore("/shared/myrun.dag")
+    a_ids = ag.insert_tasks(queue_url, "stage_a", a_args, a_kwargs)
+    ag.insert_tasks(queue_url, "stage_b", b_args, b_kwargs,
+                    parents=[a_ids] * len(b_args), dag_store=store)
+    ag.poll(queue_url, "stage_a", parse_a, dag_store=store)
+"""
+from __future__ import annotations
+
+import abc
+import sqlite3
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from . import sqlite
+from . import queuetools as qt
+
+
+@dataclass
+class HeldTask:
+    """An encoded task waiting for its parents, and where to publish it."""
+
+    task_id: str
+    queue_url: str
+    queue_name: str
+    body: bytes
+    content_type: Optional[str]
+
+
+class Store(abc.ABC):
+    """Interface for dependency storage shared by submitters and workers.
+
+    Implementations must make hold and complete atomic with respect to each
+    other, so that a child is released exactly when its last parent finishes.
+    """
+
+    @abc.abstractmethod
+    def hold(self, task: HeldTask, parents: Iterable[str]) -> bool:
+        """Holds a task until its parents complete.
+
+        Returns:
+            False if every parent has already completed (so the task wasn't
+            held and should be published now), True otherwise.
+        """
+
+    @abc.abstractmethod
+    def complete(self, task_id: str) -> list[HeldTask]:
+        """Records a completed task and returns its children that are ready.
+
+        Completing a task twice doesn't decrement its children twice. Ready
+        children are returned until they're marked as released.
+        """
+
+    @abc.abstractmethod
+    def mark_released(self, task_ids: Iterable[str]) -> None:
+        """Records that ready children have been published."""
+
+    @abc.abstractmethod
+    def is_complete(self, task_id: str) -> bool:
+        """Checks whether a task has been recorded as completed."""
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS held (
+    task_id TEXT PRIMARY KEY,
+    queue_url TEXT NOT NULL,
+    queue_name TEXT NOT NULL,
+    body BLOB NOT NULL,
+    content_type TEXT,
+    remaining INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS edges (
+    parent TEXT NOT NULL,
+    child TEXT NOT NULL,
+    PRIMARY KEY (parent, child)
+);
+CREATE TABLE IF NOT EXISTS completed (
+    task_id TEXT PRIMARY KEY
+);
+"""
+
+
+class SQLiteStore(Store):
+    """Keeps dependencies in a SQLite database (for a single node)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def hold(self, task: HeldTask, parents: Iterable[str]) -> bool:
+        parents = set(parents)
+
+        with self._lock, sqlite.transaction(self._db, immediate=True):
+            unfinished = [
+                parent
+                for parent in parents
+                if self._db.execute(
+                    "SELECT 1 FROM completed WHERE task_id = ?", (parent,)
+                ).fetchone()
+                is None
+            ]
+
+            if unfinished:
+                self._db.execute(
+                    "INSERT INTO held VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        task.task_id,
+                        task.queue_url,
+                        task.queue_name,
+                        task.body,
+                        task.content_type,
+                        len(unfinished),
+                    ),
+                )
+                self._db.executemany(
+                    "INSERT INTO edges VALUES (?, ?)",
+                    [(parent, task.task_id) for parent in unfinished],
+                )
+
+        return len(unfinished) > 0
+
+    def complete(self, task_id: str) -> list[HeldTask]:
+        with self._lock, sqlite.transaction(self._db, immediate=True):
+            first = self._db.execute(
+                "INSERT OR IGNORE INTO completed VALUES (?)", (task_id,)
+            ).rowcount
+            if first:
+                self._db.execute(
+                    "UPDATE held SET remaining = remaining - 1"
+                    " WHERE task_id IN (SELECT child FROM edges WHERE parent = ?)",
+                    (task_id,),
+                )
+
+            rows = self._db.execute(
+                "SELECT task_id, queue_url, queue_name, body, content_type"
+                " FROM held WHERE remaining <= 0 AND task_id IN"
+                " (SELECT child FROM edges WHERE parent = ?)",
+                (task_id,),
+            ).fetchall()
+
+        return [HeldTask(*row) for row in rows]
+
+    def mark_released(self, task_ids: Iterable[str]) -> None:
+        task_ids = list(task_ids)
+
+        with self._lock, sqlite.transaction(self._db, immediate=True):
+            self._db.executemany(
+                "DELETE FROM held WHERE task_id = ?", [(t,) for t in task_ids]
+            )
+            self._db.executemany(
+                "DELETE FROM edges WHERE child = ?", [(t,) for t in task_ids]
+            )
+
+    def is_complete(self, task_id: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM completed WHERE task_id = ?", (task_id,)
+            ).fetchone()
+
+        return row is not None
+
+    def num_held(self) -> int:
+        """Counts the tasks still waiting for their parents."""
+        with self._lock:
+            (count,) = self._db.execute("SELECT COUNT(*) FROM held").fetchone()
+
+        return count
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def release(store: Store, task_id: str) -> list[str]:
+    """Records a completed task and publishes the children it unblocked.
+
+    Delivery is at-least-once: children are marked as released only after
+    they're published, so a worker that dies in between republishes them when
+    its task is redelivered. Children are published with their task IDs as
+    deduplication IDs (for SQS FIFO queues), and poll skips those that have
+    already completed.
+
+    Returns:
+        The IDs of the published children.
+    """
+    ready = store.complete(task_id)
+    if len(ready) == 0:
+        return list()
+
+    batches = defaultdict(list)
+    for task in ready:
+        batches[(task.queue_url, task.queue_name, task.content_type)].append(task)
+
+    for ((queue_url, queue_name, content_type), tasks) in batches.items():
+        qt.insert_msgs(
+            queue_url,
+            queue_name,
+            [task.body for task in tasks],
+            content_type=content_type,
+            dedup_ids=[task.task_id for task in tasks],
+        )
+
+    task_ids = [task.task_id for task in ready]
+    store.mark_released(task_ids)
+
+    return task_ids
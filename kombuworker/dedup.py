@@ -0,0 +1,178 @@
+"""Skipping duplicate tasks at insert time.
+
+Orchestrators that regenerate a task set after a partial failure re-insert
+many tasks that are still pending. An Index remembers the content hash of
+every submitted task until a worker completes it, so insert_tasks can skip
+tasks that are already in the queue. The index lives in a SQLite database,
+fronted by an in-memory Bloom filter so that checking new tasks (the common
+case) doesn't touch the disk, even with tens of millions of entries.
+
+Example:
+    index = dedup.Index("/shared/myrun.dedup")
+    ag.insert_tasks(queue_url, "mytool", args, kwargs, dedup_index=index)
+    ag.poll(queue_url, "mytool", task_parser, dedup_index=index)
+"""
+from __future__ import annotations
+
+import math
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Iterable, Optional, Union
+
+from . import codec
+from . import sqlite
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+    key TEXT PRIMARY KEY,
+    task_id TEXT
+);
+"""
+
+
+def content_key(body: Union[str, bytes]) -> str:
+    """Hashes a serialized task payload."""
+    if isinstance(body, str):
+        body = body.encode()
+
+    return hashlib.sha256(body).hexdigest()
+
+
+def payload_key(obj: Any) -> str:
+    """Hashes a task payload, encoded on its own (rather than in a batch)."""
+    (body,), _ = codec.encode([obj])
+
+    return content_key(body)
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter of string keys.
+
+    Args:
+        capacity: The number of keys to size the filter for.
+        error_rate: The false positive rate at capacity.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, key: str) -> None:
+        for i in self._positions(key):
+            self._bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[i >> 3] & (1 << (i & 7)) for i in self._positions(key))
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # double hashing from two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+
+class Index:
+    """A persistent index of submitted tasks that haven't completed yet.
+
+    Keys are content hashes (see content_key), each mapped to the id of the
+    task that was submitted with it (if any). The Bloom filter only covers
+    keys loaded or added by this process, so processes that submit to the
+    same index concurrently may each publish a task once.
+
+    Args:
+        path: The SQLite database of the index.
+        capacity: The expected number of pending tasks, which sizes the Bloom
+            filter. It keeps working beyond this, with more false positives.
+        error_rate: The Bloom filter's false positive rate at capacity.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        capacity: int = 1_000_000,
+        error_rate: float = 0.001,
+    ):
+        self.path = path
+
+        self._db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+        self._bloom = BloomFilter(capacity, error_rate)
+        for (key,) in self._db.execute("SELECT key FROM pending"):
+            self._bloom.add(key)
+
+    def submit(
+        self, keys: list[str], task_ids: Optional[list[str]] = None
+    ) -> list[Optional[str]]:
+        """Records the keys of tasks about to be submitted.
+
+        Returns:
+            For each key, None if it's new (and now recorded), or the task id
+            recorded with it by an earlier submission that's still pending.
+            Keys repeated within one call count as duplicates of their first
+            occurrence.
+        """
+        task_ids = list(keys) if task_ids is None else task_ids
+        assert len(task_ids) == len(keys), "mismatched keys & task_ids"
+
+        results: list[Optional[str]] = list()
+        new: dict[str, str] = dict()
+
+        with self._lock:
+            for (key, task_id) in zip(keys, task_ids):
+                if key in new:
+                    results.append(new[key])
+                    continue
+
+                existing = None
+                if key in self._bloom:  # otherwise definitely new
+                    row = self._db.execute(
+                        "SELECT task_id FROM pending WHERE key = ?", (key,)
+                    ).fetchone()
+                    existing = None if row is None else row[0]
+
+                if existing is None:
+                    new[key] = task_id
+                results.append(existing)
+
+            with sqlite.transaction(self._db):
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO pending (key, task_id) VALUES (?, ?)",
+                    new.items(),
+                )
+
+            for key in new:
+                self._bloom.add(key)
+
+        return results
+
+    def complete(self, key: str) -> None:
+        """Forgets a completed task, so that it can be submitted again."""
+        with self._lock:
+            self._db.execute("DELETE FROM pending WHERE key = ?", (key,))
+
+    def discard(self, keys: Iterable[str]) -> None:
+        """Forgets the keys of tasks that failed to be submitted."""
+        with self._lock:
+            with sqlite.transaction(self._db):
+                self._db.executemany(
+                    "DELETE FROM pending WHERE key = ?", [(key,) for key in keys]
+                )
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._db.execute("SELECT COUNT(*) FROM pending").fetchone()
+
+        return count
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,22 @@
+"""Filesystem transport that keeps exchange state per queue folder.
+
+kombu's filesystem transport shares its exchange bindings across every
+connection in a process. A binding declared for one folder then suppresses
+writing the routing table for any other folder, and messages published there
+are silently dropped.
+"""
+from __future__ import annotations
+
+from kombu.transport import virtual
+from kombu.transport import filesystem
+
+
+class Transport(filesystem.Transport):
+    """Filesystem Transport with per-folder state."""
+
+    states: dict[str, virtual.BrokerState] = dict()
+
+    def __init__(self, client, **kwargs):
+        super().__init__(client, **kwargs)
+        folder = client.transport_options.get("control_folder", "control")
+        self.state = self.states.setdefault(folder, virtual.BrokerState())
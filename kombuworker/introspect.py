@@ -0,0 +1,205 @@
+"""Live introspection of running workers.
+
+Each consumer can report its state to a Status: what its fetch thread is
+doing, the message being worked on (and for how long), the current backoff
+period and the last queue depth it saw. A worker can serve every status in
+its process, along with stack dumps of all of its threads, over HTTP on a
+local port or a Unix socket:
+
+    curl localhost:8765/status
+    curl --unix-socket /tmp/worker.sock http://worker/stacks
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional, Union
+
+from .log import logger
+
+
+class Status:
+    """The live state of one consumer, shared between its threads.
+
+    Fields are updated by the fetch thread (fetch_state, fetch_activity), the
+    fetch loop (backoff, queue_depth) and the worker (the current message).
+    Statuses register themselves so that serve can report them.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._fields: dict[str, Any] = dict(
+            fetch_state=None,
+            fetch_activity=None,
+            backoff=None,
+            queue_depth=None,
+            queue_depth_time=None,
+            msg_id=None,
+            msg_start_time=None,
+            num_tasks=0,
+        )
+
+        _register(self)
+
+    def update(self, **fields: Any) -> None:
+        with self._lock:
+            self._fields.update(fields)
+
+    def start_task(self, msg_id: Optional[str]) -> None:
+        """Marks the start of work on a message."""
+        self.update(msg_id=msg_id, msg_start_time=time.time())
+
+    def finish_task(self) -> None:
+        """Marks the end of work on the current message."""
+        with self._lock:
+            self._fields.update(msg_id=None, msg_start_time=None)
+            self._fields["num_tasks"] += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns a JSON-serializable copy of the current state."""
+        with self._lock:
+            fields = dict(self._fields)
+
+        start_time = fields.pop("msg_start_time")
+        fields["msg_age"] = None if start_time is None else time.time() - start_time
+
+        return dict(name=self.name, **fields)
+
+    def close(self) -> None:
+        """Stops reporting this status."""
+        _unregister(self)
+
+
+# Statuses of this process's consumers
+__STATUSES: list[Status] = list()
+__STATUSES_LOCK = threading.Lock()
+
+
+def _register(status: Status) -> None:
+    with __STATUSES_LOCK:
+        __STATUSES.append(status)
+
+
+def _unregister(status: Status) -> None:
+    with __STATUSES_LOCK:
+        if status in __STATUSES:
+            __STATUSES.remove(status)
+
+
+def statuses() -> list[dict[str, Any]]:
+    """Snapshots every status registered in this process."""
+    with __STATUSES_LOCK:
+        current = list(__STATUSES)
+
+    return [status.snapshot() for status in current]
+
+
+def stack_dumps() -> str:
+    """Formats the current stack of every thread in this process."""
+    names = {th.ident: th.name for th in threading.enumerate()}
+
+    dumps = list()
+    for ident, frame in sys._current_frames().items():
+        header = f"Thread {names.get(ident, 'unknown')} ({ident}):\n"
+        dumps.append(header + "".join(traceback.format_stack(frame)))
+
+    return "\n".join(dumps)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/status":
+            body = json.dumps(statuses(), default=str).encode()
+            content_type = "application/json"
+        elif self.path == "/stacks":
+            body = stack_dumps().encode()
+            content_type = "text/plain"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients don't have a (host, port) address
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        logger.debug(f"introspection request: {format % args}")
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # clear a socket left behind by a previous worker
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def _unix_path(address: str) -> Optional[str]:
+    """Returns the socket path of a Unix socket address (None for TCP)."""
+    if address.startswith("unix:"):
+        return address[len("unix:") :]
+    if address.startswith("tcp:"):
+        return None
+
+    # anything that isn't "host:port" (or a port) is a path
+    _, _, port = address.rpartition(":")
+    return None if port.isdigit() else address
+
+
+def serve(address: str) -> Union[ThreadingHTTPServer, _UnixHTTPServer]:
+    """Serves this process's statuses and stack dumps in a background thread.
+
+    Args:
+        address: Either "host:port" (or just a port) for an HTTP server, or a
+            path for a Unix socket. Prefixing "tcp:" or "unix:" picks the kind
+            explicitly.
+
+    Returns:
+        The running server. Call stop to stop it.
+    """
+    server: Union[ThreadingHTTPServer, _UnixHTTPServer]
+    unix_path = _unix_path(address)
+    if unix_path is not None:
+        server = _UnixHTTPServer(unix_path, _Handler)
+    else:
+        if address.startswith("tcp:"):
+            address = address[len("tcp:") :]
+        host, _, port = address.rpartition(":")
+        if not port.isdigit():
+            raise ValueError(f"invalid introspection address: {address}")
+        server = ThreadingHTTPServer((host or "localhost", int(port)), _Handler)
+        server.daemon_threads = True
+
+    th = threading.Thread(target=server.serve_forever, name="introspection")
+    th.daemon = True
+    th.start()
+    logger.info(f"Serving worker introspection at {address}")
+
+    return server
+
+
+def stop(server: Union[ThreadingHTTPServer, _UnixHTTPServer]) -> None:
+    """Stops a server started by serve, closing (and removing) its socket."""
+    server.shutdown()
+    server.server_close()
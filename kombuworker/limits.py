@@ -0,0 +1,230 @@
+"""Rate limits and concurrency caps for task execution.
+
+A Limiter combines a token bucket (tasks per second, with bursts) and a cap
+on concurrently running tasks. Limiters are shared by name within a process.
+Given a lock_dir, they also coordinate through lock files with every other
+process on the node that uses the same directory and name, so a fleet of
+workers backs off together instead of overwhelming a shared backing store.
+"""
+from __future__ import annotations
+
+import os
+import time
+import fcntl
+import threading
+import contextlib
+from typing import Iterator, Optional, TextIO
+
+
+class Limiter:
+    """Blocks task execution to respect a rate limit and concurrency cap.
+
+    Args:
+        name: An identifier for the limited resource (e.g., a queue name).
+        rate: The maximum number of acquisitions per second (None for no limit).
+        burst: The number of acquisitions allowed at once after idling.
+        max_concurrent: The maximum number of holders at a time (None for no
+            limit).
+        lock_dir: A directory for lock files that coordinate limits across
+            processes. Limits only apply within this process if None.
+        poll_interval: How long to wait between attempts to find a free
+            concurrency slot.
+
+    Example:
+        with limiter:
+            task()
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: Optional[float] = None,
+        burst: int = 1,
+        max_concurrent: Optional[int] = None,
+        lock_dir: Optional[str] = None,
+        poll_interval: float = 0.05,
+    ):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.lock_dir = lock_dir
+        self.poll_interval = poll_interval
+
+        # in-process state
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last_time = time.monotonic()
+        self._semaphore = (
+            threading.BoundedSemaphore(max_concurrent)
+            if max_concurrent is not None and lock_dir is None
+            else None
+        )
+        self._slots = threading.local()
+
+        if lock_dir is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def acquire(self) -> None:
+        """Waits for a concurrency slot, and then for a rate-limit token."""
+        if self.max_concurrent is not None:
+            self._acquire_slot()
+
+        if self.rate is not None:
+            while True:
+                wait_time = self._take_token()
+                if wait_time <= 0:
+                    break
+                time.sleep(wait_time)
+
+    def release(self) -> None:
+        """Frees the concurrency slot taken by acquire."""
+        if self.max_concurrent is None:
+            return
+
+        if self._semaphore is not None:
+            self._semaphore.release()
+        else:
+            slot = self._slots.file
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+            self._slots.file = None
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        """Holds a concurrency slot without taking a rate-limit token."""
+        if self.max_concurrent is not None:
+            self._acquire_slot()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def __enter__(self) -> Limiter:
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+    def _acquire_slot(self) -> None:
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+            return
+
+        while True:
+            for i in range(self.max_concurrent):  # type: ignore[arg-type]
+                slot = open(self._lock_path(f"slot{i}"), "a")
+                try:
+                    fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    slot.close()
+                    continue
+
+                # held until release (or until this process dies)
+                self._slots.file = slot
+                return
+
+            time.sleep(self.poll_interval)
+
+    def _take_token(self) -> float:
+        """Takes a token if one is available, or returns how long to wait."""
+        if self.lock_dir is None:
+            with self._lock:
+                self._tokens, self._last_time, wait_time = self._refill(
+                    self._tokens, self._last_time, time.monotonic()
+                )
+            return wait_time
+
+        with open(self._lock_path("bucket"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                tokens, last_time = _read_bucket(f, self.burst)
+                tokens, last_time, wait_time = self._refill(
+                    tokens, last_time, time.time()
+                )
+                _write_bucket(f, tokens, last_time)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        return wait_time
+
+    def _refill(
+        self, tokens: float, last_time: float, now: float
+    ) -> tuple[float, float, float]:
+        """Advances a token bucket, taking a token if possible."""
+        rate = self.rate
+        assert rate is not None
+
+        tokens = min(float(self.burst), tokens + (now - last_time) * rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0.0
+
+        return tokens, now, (1 - tokens) / rate
+
+    def _lock_path(self, suffix: str) -> str:
+        assert self.lock_dir is not None
+        filename = self.name.replace(os.sep, "_")
+
+        return os.path.join(self.lock_dir, f"{filename}.{suffix}")
+
+
+def _read_bucket(f: TextIO, burst: int) -> tuple[float, float]:
+    f.seek(0)
+    contents = f.read().split()
+
+    if len(contents) != 2:  # new bucket
+        return float(burst), time.time()
+
+    return float(contents[0]), float(contents[1])
+
+
+def _write_bucket(f: TextIO, tokens: float, last_time: float) -> None:
+    f.seek(0)
+    f.truncate()
+    f.write(f"{tokens} {last_time}")
+    f.flush()
+
+
+# Limiters shared by name within this process
+__LIMITERS: dict[str, Limiter] = dict()
+__LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(
+    name: str,
+    rate: Optional[float] = None,
+    burst: int = 1,
+    max_concurrent: Optional[int] = None,
+    lock_dir: Optional[str] = None,
+) -> Limiter:
+    """Returns this process's limiter for a name, creating it if needed.
+
+    A call without a rate or max_concurrent returns the limiter registered
+    for the name, or an unregistered limiter with no limits if there isn't
+    one, so that later calls can still set limits.
+
+    Raises:
+        ValueError: if the name's limiter was created with different limits.
+    """
+    if rate is None and max_concurrent is None:
+        with __LIMITERS_LOCK:
+            return __LIMITERS.get(name) or Limiter(name)
+
+    with __LIMITERS_LOCK:
+        if name not in __LIMITERS:
+            __LIMITERS[name] = Limiter(
+                name,
+                rate=rate,
+                burst=burst,
+                max_concurrent=max_concurrent,
+                lock_dir=lock_dir,
+            )
+
+        limiter = __LIMITERS[name]
+
+    current = (limiter.rate, limiter.burst, limiter.max_concurrent, limiter.lock_dir)
+    if (rate, burst, max_concurrent, lock_dir) != current:
+        raise ValueError(f"{name} already has a limiter with different limits")
+
+    return limiter
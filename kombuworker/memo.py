@@ -0,0 +1,190 @@
+"""Memoization of expensive per-task setup.
+
+Task parsers often repeat the same setup (loading models, opening volumes)
+for thousands of tasks. Wrapping that setup with memoize caches its results
+keyed by a declared subset of the task's kwargs.
+
+Example:
+    @memoize(["model_path"], maxsize=2, ttl=3600)
+    def load_model(model_path):
+        ...
+
+    def task_parser(chunk, **kwargs):
+        model = load_model(**kwargs)  # only model_path is passed along
+        return partial(run, model, chunk)
+"""
+from __future__ import annotations
+
+import sys
+import json
+import time
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+from .log import logger
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional
+    np = None  # type: ignore[assignment]
+
+
+class LRUCache:
+    """A thread-safe LRU cache with optional TTL and memory bounds.
+
+    Args:
+        maxsize: The maximum number of entries (None for no limit).
+        ttl: How many seconds an entry stays valid (None for no limit).
+        max_bytes: The maximum total size of entries as measured by sizeof
+            (None for no limit). Values larger than this aren't cached.
+        sizeof: Measures an entry's value. Defaults to sys.getsizeof, which
+            doesn't measure contained objects.
+    """
+
+    def __init__(
+        self,
+        maxsize: Optional[int] = 128,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = sys.getsizeof,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        # key -> (value, creation time, size)
+        self._entries: OrderedDict = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key in self._entries:
+                value, created, _ = self._entries[key]
+                if self.ttl is None or time.monotonic() - created < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                self._pop(key)
+
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+            self._entries[key] = (value, time.monotonic(), size)
+            self._num_bytes += size
+
+            while self._over_limits():
+                self._pop(next(iter(self._entries)))
+
+    def _over_limits(self) -> bool:
+        return (self.maxsize is not None and len(self._entries) > self.maxsize) or (
+            self.max_bytes is not None and self._num_bytes > self.max_bytes
+        )
+
+    def _pop(self, key: Hashable) -> None:
+        _, _, size = self._entries.pop(key)
+        self._num_bytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def memoize(
+    keys: Iterable[str],
+    maxsize: Optional[int] = 16,
+    ttl: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+    sizeof: Callable[[Any], int] = sys.getsizeof,
+) -> Callable[[Callable], Callable]:
+    """Caches a setup function by a subset of the kwargs it's called with.
+
+    The decorated function accepts any kwargs, but is only given (and cached
+    by) those named in keys, so missing keys fall back to the function's
+    defaults. The cache is available as the decorated function's cache
+    attribute (see LRUCache).
+
+    Kwargs are keyed by their JSON encoding, except for bytes and numpy
+    arrays, which are keyed by a hash of their contents. Calls with other
+    kwarg values aren't cached.
+
+    Concurrent misses for the same key may each run the setup function.
+    """
+    keys = tuple(keys)
+
+    def decorator(fn: Callable) -> Callable:
+        cache = LRUCache(maxsize=maxsize, ttl=ttl, max_bytes=max_bytes, sizeof=sizeof)
+        missing = object()
+
+        @functools.wraps(fn)
+        def wrapper(**kwargs: Any) -> Any:
+            subset = {k: kwargs[k] for k in keys if k in kwargs}
+            key = _make_key(keys, subset)
+            if key is None:
+                logger.warning(f"Cannot memoize {fn.__name__} by {keys}, not caching")
+                return fn(**subset)
+
+            value = cache.get(key, missing)
+            if value is missing:
+                value = fn(**subset)
+                cache.put(key, value)
+
+            return value
+
+        wrapper.cache = cache  # type: ignore[attr-defined]
+
+        return wrapper
+
+    return decorator
+
+
+def _make_key(keys: tuple[str, ...], subset: dict[str, Any]) -> Optional[str]:
+    """Builds a hashable key from kwarg values, or None if they can't be keyed.
+
+    Values must be JSON-like, or binary (bytes or numpy arrays, keyed by their
+    contents). Missing kwargs are keyed apart from kwargs set to None.
+    """
+    try:
+        return json.dumps(
+            [[k, subset[k]] for k in keys if k in subset],
+            sort_keys=True,
+            default=_binary_key,
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def _binary_key(value: Any) -> Any:
+    """Keys binary values by a hash of their contents."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"sha256": hashlib.sha256(memoryview(value).tobytes()).hexdigest()}
+
+    elif np is not None and isinstance(value, np.ndarray):
+        return {
+            "sha256": hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest(),
+            "dtype": value.dtype.str,
+            "shape": list(value.shape),
+        }
+
+    raise TypeError(f"cannot memoize by a {type(value).__name__}")
@@ -0,0 +1,20 @@
+"""In-memory transport that redelivers un-acked messages.
+
+kombu's memory transport drops messages that are still un-acked when their
+connection closes, while every other transport makes them available again.
+"""
+from __future__ import annotations
+
+from kombu.transport import memory
+
+
+class Channel(memory.Channel):
+    """Memory Channel that restores un-acked messages on close."""
+
+    do_restore = True
+
+
+class Transport(memory.Transport):
+    """Memory Transport with redelivery."""
+
+    Channel = Channel
@@ -2,20 +2,28 @@
 from __future__ import annotations
 
 import time
+import heapq
+import atexit
 import queue
 import socket
+import pathlib
+import functools
+import itertools
 import requests
 import threading
 from enum import Enum
+from collections import defaultdict
 from time import sleep
 from urllib.parse import urlparse
-from typing import Generator, Iterable, Optional
+from typing import Any, Callable, Generator, Iterable, Optional, Union
 
 import kombu
 import tenacity
 from kombu import Connection
 from kombu.simple import SimpleQueue
 
+from . import capture, sqlite, memory, filesystem
+from .introspect import Status
 from .log import logger
 
 
@@ -26,11 +34,61 @@ retry = tenacity.retry(
     wait=tenacity.wait_random_exponential(multiplier=0.5, max=60.0),
 )
 
-# Queues for inter-thread communication
-# these should only hold one message at most unless someone's messing with them
-__REC_THREADQ: queue.Queue = queue.Queue()  # stores received messages
-__ACK_THREADQ: queue.Queue = queue.Queue()  # whether to 'ack' the received messages
-__DIE_THREADQ: queue.Queue = queue.Queue()  # whether to 'ack' the received messages
+# Fetched messages remember the ack queue of the fetch thread that owns them
+ACK_THREADQ_ATTR = "_kombuworker_ack_threadq"
+
+# Transports that run on a single node without a broker
+LOCAL_SCHEMES = ("memory://", "filesystem://", "sqlite://")
+DEFAULT_LOCAL_DIR = "/tmp/kombuworker"
+
+SQS_BATCH_SIZE = 10  # maximum number of entries in an SQS batch request
+SQS_MAX_DELAY = 900  # seconds
+
+DELAY_QUEUE_EXPIRY_MS = 60_000  # how long unused RabbitMQ delay queues persist
+
+
+def connect(queue_url: str, **kwargs) -> Connection:
+    """Opens a connection to a queue, configuring local transports as needed.
+
+    Local transports take their storage location from the url, e.g.,
+    "filesystem:///path/to/folder" or "sqlite:///path/to/queue.db".
+    """
+    if queue_url.startswith("filesystem://"):
+        folder = pathlib.Path(local_path(queue_url))
+        data_folder = folder / "data"
+        control_folder = folder / "control"
+        data_folder.mkdir(parents=True, exist_ok=True)
+        control_folder.mkdir(parents=True, exist_ok=True)
+
+        kwargs.setdefault("transport_options", {}).update(
+            data_folder_in=str(data_folder),
+            data_folder_out=str(data_folder),
+            control_folder=str(control_folder),
+        )
+        kwargs.setdefault("transport", filesystem.Transport)
+
+    elif queue_url.startswith("memory://"):
+        kwargs.setdefault("transport", memory.Transport)
+
+    elif queue_url.startswith("sqlite://"):
+        database = pathlib.Path(local_path(queue_url))
+        database.parent.mkdir(parents=True, exist_ok=True)
+
+        kwargs.setdefault("transport_options", {}).update(database=str(database))
+
+    return Connection(queue_url, **kwargs)
+
+
+def local_path(queue_url: str) -> str:
+    """Extracts the storage location of a local transport from its url."""
+    parsed = urlparse(queue_url)
+    path = parsed.netloc + parsed.path
+
+    if path == "":
+        default = f"{DEFAULT_LOCAL_DIR}/{parsed.scheme}"
+        return default + ".db" if parsed.scheme == "sqlite" else default
+
+    return path
 
 
 def insert_msgs(
@@ -38,17 +96,188 @@ def insert_msgs(
     queue_name: str,
     payloads: Iterable,
     connect_timeout: int = 60,
+    content_type: Optional[str] = None,
+    delay: Optional[float] = None,
+    dedup_ids: Optional[list[str]] = None,
 ) -> None:
-    """Inserts multiple messages into a queue."""
-    with Connection(queue_url, connect_timeout=connect_timeout) as conn:
+    """Inserts multiple messages into a queue.
+
+    Payloads are serialized by kombu unless a content_type is given, in which
+    case they're published as raw (already-encoded) bodies.
+
+    Messages can be delayed by a number of seconds before they're delivered.
+    SQS uses DelaySeconds (up to 15 minutes). RabbitMQ holds the messages in
+    a per-delay queue with a message TTL, which dead-letters them into the
+    destination queue. SQLite queues keep them invisible until they're due.
+    Other (in-process) transports hold them in a local delay heap, so they're
+    lost if this process exits before they're due (see DelayHeap). Messages
+    within RabbitMQ delay queues or the local heap aren't counted by num_msgs.
+    SQS FIFO queues can't delay individual messages, and raise a ValueError.
+
+    SQS FIFO queues (named "*.fifo") drop messages that repeat one of the
+    dedup_ids (one per payload) within five minutes. Other queues ignore them.
+    """
+    payloads = list(payloads)
+    if dedup_ids is not None:
+        assert len(dedup_ids) == len(payloads), "mismatched payloads & dedup_ids"
+    fifo = queue_url.startswith("sqs://") and queue_name.endswith(".fifo")
+    properties: dict = dict()
+    delay = 0 if delay is None else delay
+    delayed = delay > 0
+    rabbitmq = queue_url.startswith(("amqp://", "amqps://"))
+
+    if delayed:
+        if fifo:
+            raise ValueError("SQS FIFO queues can't delay individual messages")
+
+        if queue_url.startswith("sqs://"):
+            if delay > SQS_MAX_DELAY:
+                raise ValueError(f"SQS can't delay messages over {SQS_MAX_DELAY}s")
+            properties["DelaySeconds"] = int(round(delay))
+
+        elif queue_url.startswith("sqlite://"):
+            properties["not_before"] = time.time() + delay
+
+        elif not rabbitmq:
+            return __DELAY_HEAP.push(
+                time.time() + delay,
+                functools.partial(
+                    insert_msgs,
+                    queue_url,
+                    queue_name,
+                    payloads,
+                    connect_timeout=connect_timeout,
+                    content_type=content_type,
+                    dedup_ids=dedup_ids,
+                ),
+            )
+
+    with connect(queue_url, connect_timeout=connect_timeout) as conn:
         queue = conn.SimpleQueue(queue_name)
-        for payload in payloads:
-            submit_msg(queue, payload)
+
+        if delayed and rabbitmq:
+            queue = _rabbitmq_delay_queue(conn, queue_name, delay)
+
+        for (i, payload) in enumerate(payloads):
+            if fifo and dedup_ids is not None:
+                properties["MessageDeduplicationId"] = dedup_ids[i]
+            submit_msg(queue, payload, content_type=content_type, **properties)
 
 
 @retry
-def submit_msg(queue: SimpleQueue, payload: str) -> None:
-    queue.put(payload)
+def submit_msg(
+    queue: SimpleQueue,
+    payload: Union[str, bytes],
+    content_type: Optional[str] = None,
+    **properties,
+) -> None:
+    if content_type is None:
+        queue.put(payload, **properties)
+    else:
+        queue.put(payload, content_type=content_type, **properties)
+
+
+def _rabbitmq_delay_queue(conn: Connection, queue_name: str, delay: float):
+    """Declares a queue that dead-letters messages to queue_name after delay.
+
+    RabbitMQ only expires messages at the head of a queue, so each delay gets
+    its own queue. These delete themselves after they're no longer used.
+    """
+    delay_ms = int(delay * 1000)
+
+    return conn.SimpleQueue(
+        f"{queue_name}::delay{delay_ms}",
+        queue_args={
+            "x-message-ttl": delay_ms,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": queue_name,
+            "x-expires": delay_ms + DELAY_QUEUE_EXPIRY_MS,
+        },
+    )
+
+
+class DelayHeap:
+    """Runs callbacks once they're due, in a background thread.
+
+    The thread only runs while callbacks are waiting. It's a daemon, so it
+    never keeps a process alive; callbacks still waiting when the process
+    exits are dropped (with a warning). Call join to wait for them instead.
+    """
+
+    def __init__(self):
+        self._heap: list = list()
+        self._counter = itertools.count()  # breaks ties between due times
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def push(self, due_time: float, callback: Callable[[], Any]) -> None:
+        with self._cond:
+            heapq.heappush(self._heap, (due_time, next(self._counter), callback))
+            self._cond.notify()
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Waits for every waiting callback to run.
+
+        Returns:
+            Whether they all ran within the timeout.
+        """
+        end_time = None if timeout is None else time.time() + timeout
+
+        while True:
+            with self._cond:
+                thread = self._thread
+            if thread is None:
+                return True
+
+            thread.join(None if end_time is None else max(end_time - time.time(), 0))
+            if thread.is_alive():
+                return False
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if len(self._heap) == 0:
+                    self._thread = None
+                    return
+
+                due_time, _, callback = self._heap[0]
+                if due_time > time.time():
+                    self._cond.wait(due_time - time.time())
+                    continue
+
+                heapq.heappop(self._heap)
+
+            try:
+                callback()
+            except Exception:
+                logger.exception("Failed to publish delayed messages")
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+__DELAY_HEAP = DelayHeap()
+
+
+@atexit.register
+def _warn_dropped_delays() -> None:
+    if len(__DELAY_HEAP) > 0:
+        logger.warning(f"Dropping {len(__DELAY_HEAP)} delayed inserts at exit")
+
+
+def wait_for_delayed(timeout: Optional[float] = None) -> bool:
+    """Waits for this process's delayed inserts to be published.
+
+    Only inserts held in the local delay heap are waited for (see insert_msgs).
+
+    Returns:
+        Whether they were all published within the timeout.
+    """
+    return __DELAY_HEAP.join(timeout)
 
 
 def fetch_msgs(
@@ -58,20 +287,66 @@ def fetch_msgs(
     max_waiting_period: int = 60,
     max_num_retries: int = 5,
     verbose: bool = False,
-    rec_threadq: queue.Queue = __REC_THREADQ,
-    ack_threadq: queue.Queue = __ACK_THREADQ,
-    die_threadq: queue.Queue = __DIE_THREADQ,
+    rec_threadq: Optional[queue.Queue] = None,
+    ack_threadq: Optional[queue.Queue] = None,
+    die_threadq: Optional[queue.Queue] = None,
+    ack_batch_size: int = 1,
+    ack_interval: float = 1.0,
+    steal_from: Optional[list[str]] = None,
+    status: Optional[Status] = None,
+    recorder: Optional[capture.Recorder] = None,
+    prefetch: int = 1,
+    stop_when: Optional[Callable[[], bool]] = None,
 ) -> Generator[kombu.Message, None, None]:
     """Generator for continuously pulling messages from a queue.
 
-    This is the primary interface for pulling tasks.
+    This is the primary interface for pulling tasks. Each generator runs its
+    own fetch thread with its own inter-thread queues (unless given), so
+    several generators can consume from different queues within one process.
+    See Consumer for a class-based interface.
+
+    Acks can be coalesced by setting ack_batch_size above 1. Acked messages are
+    then held by the fetch thread until the batch fills, ack_interval seconds
+    pass, the queue runs dry, or the generator is closed, and are sent to the
+    broker together (see ack_msgs).
+
+    Messages can also be taken from the queues in steal_from (in order of
+    preference), but only while queue_name is empty.
+
+    Given a status (see introspect.Status), the fetch thread and loop report
+    what they're doing, the backoff period and the last queue depth seen.
+    Given a recorder, every message and its fetch and ack times are captured
+    (see capture.Recorder).
+
+    By default, the next message is only fetched once the last one is acked.
+    With prefetch above 1, up to that many messages can be received before
+    they're acked (e.g., to prepare the next task while one runs). These
+    should be acked in the order they're received when batching acks.
+
+    stop_when is called whenever the queue is found empty, and stops the
+    generator once it returns True (e.g., to recycle an idle worker).
     """
+    steal_from = list() if steal_from is None else steal_from
+
+    # Queues for inter-thread communication: rec_threadq holds up to prefetch
+    # fetched messages, ack_threadq the acked ones until the fetch thread sends them
+    rec_threadq = queue.Queue() if rec_threadq is None else rec_threadq
+    ack_threadq = queue.Queue() if ack_threadq is None else ack_threadq
+    die_threadq = queue.Queue() if die_threadq is None else die_threadq
 
     def start_thread():
         th = threading.Thread(
             target=_fetch_thread,
             args=(queue_url, queue_name, rec_threadq, ack_threadq, die_threadq),
-            kwargs=dict(verbose=verbose, sleep_interval=init_waiting_period),
+            kwargs=dict(
+                verbose=verbose,
+                sleep_interval=init_waiting_period,
+                ack_batch_size=ack_batch_size,
+                ack_interval=ack_interval,
+                steal_from=steal_from,
+                status=status,
+                prefetch=prefetch,
+            ),
         )
         th.daemon = True
         th.start()
@@ -87,16 +362,24 @@ def fetch_msgs(
         try:
             msg = rec_threadq.get_nowait()
 
-            if verbose:
-                logger.info(f"message received: {msg}")
             waiting_period = init_waiting_period
             num_tries = 0
+            _received(msg, verbose=verbose, status=status, recorder=recorder)
 
             yield msg
 
         except queue.Empty:
+            if stop_when is not None and stop_when():
+                break
+
             try:
-                num_in_queue = num_msgs(queue_url, queue_name)
+                num_in_queue = sum(
+                    num_msgs(queue_url, name) for name in [queue_name] + steal_from
+                )
+                if status is not None:
+                    status.update(
+                        queue_depth=num_in_queue, queue_depth_time=time.time()
+                    )
                 if num_in_queue == 0:
                     if verbose:
                         logger.info("queue empty")
@@ -113,6 +396,8 @@ def fetch_msgs(
                 if max_num_retries is not None and num_tries > max_num_retries:
                     break
 
+            if status is not None:
+                status.update(backoff=waiting_period)
             sleep(waiting_period)
             waiting_period = min(waiting_period * 2, max_waiting_period)
 
@@ -128,6 +413,130 @@ def fetch_msgs(
         th.join()
 
 
+def _received(
+    msg: kombu.Message,
+    verbose: bool = False,
+    status: Optional[Status] = None,
+    recorder: Optional[capture.Recorder] = None,
+) -> None:
+    """Reports and records a message handed off by the fetch thread."""
+    if verbose:
+        logger.info(f"message received: {msg}")
+    if status is not None:
+        status.update(backoff=None)
+    if recorder is not None:
+        recorder.record_fetch(msg)
+
+
+class Consumer:
+    """A message consumer that owns its fetch thread and handoff queues.
+
+    Each consumer keeps its own broker connection (within its fetch thread),
+    so many consumers can run in parallel within one process without
+    receiving or acking each other's messages.
+
+    Example:
+        with Consumer(queue_url, queue_name) as consumer:
+            for msg in consumer:
+                ...
+                consumer.ack(msg)
+    """
+
+    def __init__(
+        self,
+        queue_url: str,
+        queue_name: str,
+        init_waiting_period: int = 1,
+        max_waiting_period: int = 60,
+        max_num_retries: int = 5,
+        verbose: bool = False,
+        ack_batch_size: int = 1,
+        ack_interval: float = 1.0,
+        steal_from: Optional[list[str]] = None,
+        status: Optional[Status] = None,
+        recorder: Optional[capture.Recorder] = None,
+        prefetch: int = 1,
+        stop_when: Optional[Callable[[], bool]] = None,
+    ):
+        self.queue_url = queue_url
+        self.queue_name = queue_name
+        self.init_waiting_period = init_waiting_period
+        self.max_waiting_period = max_waiting_period
+        self.max_num_retries = max_num_retries
+        self.verbose = verbose
+        self.ack_batch_size = ack_batch_size
+        self.ack_interval = ack_interval
+        self.steal_from = steal_from
+        self.status = status
+        self.recorder = recorder
+        self.prefetch = prefetch
+        self.stop_when = stop_when
+
+        self.rec_threadq: queue.Queue = queue.Queue()
+        self.ack_threadq: queue.Queue = queue.Queue()
+        self.die_threadq: queue.Queue = queue.Queue()
+
+        self._it: Optional[Generator[kombu.Message, None, None]] = None
+
+    def __iter__(self) -> Generator[kombu.Message, None, None]:
+        if self._it is None:
+            self._it = fetch_msgs(
+                self.queue_url,
+                self.queue_name,
+                init_waiting_period=self.init_waiting_period,
+                max_waiting_period=self.max_waiting_period,
+                max_num_retries=self.max_num_retries,
+                verbose=self.verbose,
+                rec_threadq=self.rec_threadq,
+                ack_threadq=self.ack_threadq,
+                die_threadq=self.die_threadq,
+                ack_batch_size=self.ack_batch_size,
+                ack_interval=self.ack_interval,
+                steal_from=self.steal_from,
+                status=self.status,
+                recorder=self.recorder,
+                prefetch=self.prefetch,
+                stop_when=self.stop_when,
+            )
+
+        return self._it
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[kombu.Message]:
+        """Waits up to timeout seconds for the fetch thread's next message.
+
+        Unlike iterating, this never checks the queue or backs off while it's
+        empty, and returns None once the timeout passes (e.g., to prefetch the
+        next message only while a task runs). Iteration must have started.
+        """
+        if self._it is None:
+            raise RuntimeError("the consumer isn't fetching messages")
+
+        try:
+            msg = self.rec_threadq.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        _received(msg, verbose=self.verbose, status=self.status, recorder=self.recorder)
+
+        return msg
+
+    def ack(self, msg: kombu.Message) -> None:
+        """Acks a message received by this consumer."""
+        ack_msg(msg, self.ack_threadq)
+
+    def close(self) -> None:
+        """Stops the fetch thread, flushing any pending acks."""
+        if self._it is not None:
+            self._it.close()
+            self._it = None
+
+    def __enter__(self) -> Consumer:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
 class ThreadState(Enum):
     """A simple state switch for fetch_thread."""
 
@@ -145,37 +554,85 @@ def _fetch_thread(
     heartbeat_interval: int = 60,
     verbose: bool = False,
     sleep_interval: int = 1,
+    ack_batch_size: int = 1,
+    ack_interval: float = 1.0,
+    steal_from: Optional[list[str]] = None,
+    status: Optional[Status] = None,
+    prefetch: int = 1,
 ) -> None:
-    """Thread for fetching raw tasks and maintaining a heartbeat."""
-    with Connection(
+    """Thread for fetching raw tasks and maintaining a heartbeat.
+
+    Up to prefetch fetched messages can be waiting to be acked at a time.
+    """
+
+    def report(activity: str) -> None:
+        if status is not None:
+            status.update(fetch_state=state.name, fetch_activity=activity)
+
+    with connect(
         queue_url, connect_timeout=connect_timeout, heartbeat=10 * heartbeat_interval
     ) as conn:
-        queue = conn.SimpleQueue(queue_name)
+        # in order of preference
+        queues = [conn.SimpleQueue(name) for name in [queue_name] + (steal_from or [])]
         state = ThreadState.FETCH
         heartbeat_time = time.time()
 
+        # acked messages waiting to be sent to the broker together
+        pending_acks: list[kombu.Message] = list()
+        pending_time = time.time()
+        num_unacked = 0
+
+        def flush_acks():
+            if pending_acks:
+                report("acking")
+            ack_msgs(conn, pending_acks)
+            pending_acks.clear()
+
+        def take_acks():
+            nonlocal pending_time, num_unacked
+            while not ack_threadq.empty():
+                if not pending_acks:
+                    pending_time = time.time()
+                pending_acks.append(ack_threadq.get())
+                num_unacked -= 1
+                if len(pending_acks) >= ack_batch_size:
+                    flush_acks()
+
         while True:
 
+            if pending_acks and time.time() - pending_time > ack_interval:
+                flush_acks()
+
             if state == ThreadState.FETCH:
+                # earlier prefetched messages may be acked in the meantime
+                take_acks()
+                report("fetching")
                 try:
-                    fetch_msg(queue, rec_threadq, verbose)
-                    state = ThreadState.WAIT
+                    msg = fetch_first_msg(queues, verbose=verbose)
+                    setattr(msg, ACK_THREADQ_ATTR, ack_threadq)
+                    rec_threadq.put(msg)
+                    num_unacked += 1
+                    if num_unacked >= prefetch:
+                        state = ThreadState.WAIT
 
                 except SimpleQueue.Empty:
+                    # nothing else to batch with
+                    flush_acks()
                     conn.heartbeat_check()
+                    report("sleeping")
                     sleep(sleep_interval)
 
             elif state == ThreadState.WAIT:
                 # delete task from queue if desired
                 if not ack_threadq.empty():
-                    msg = ack_threadq.get()
-                    msg.ack()
+                    take_acks()
 
                     state = ThreadState.FETCH
                     heartbeat_time = time.time()
 
                 else:
                     if time.time() - heartbeat_time > heartbeat_interval:
+                        report("draining events")
                         try:
                             # if there is an event on the connection
                             # this counts as an implicit heartbeat?
@@ -184,13 +641,14 @@ def _fetch_thread(
                             conn.heartbeat_check()
                             heartbeat_time = time.time()
                     else:
+                        report("waiting for ack")
                         sleep(sleep_interval)
 
             if not die_threadq.empty():
-                # clean up if there's a dangling message
-                if not ack_threadq.empty():
-                    msg = ack_threadq.get()
-                    msg.ack()
+                # clean up if there are dangling messages
+                while not ack_threadq.empty():
+                    pending_acks.append(ack_threadq.get())
+                flush_acks()
 
                 die_threadq.get()
                 return
@@ -227,19 +685,108 @@ def fetch_msg(
     return msg
 
 
+def fetch_first_msg(queues: list[SimpleQueue], verbose: bool = False):
+    """Fetches a message from the first non-empty queue in a list.
+
+    Raises:
+        kombu.simple.SimpleQueue.Empty: if every queue is empty.
+    """
+    for q in queues:
+        try:
+            return fetch_msg(q, verbose=verbose)
+        except SimpleQueue.Empty:
+            continue
+
+    raise SimpleQueue.Empty()
+
+
 def print_msg_received(message: kombu.Message) -> None:
     """Prints a simple 'message received' statement with the payload."""
     logger.info(f"Fetched a message from the queue: {message.payload}")
 
 
-def ack_msg(msg: kombu.Message, ack_threadq: queue.Queue = __ACK_THREADQ) -> None:
-    """Adds a message to the ack queue to be ack'ed by the fetch thread."""
+def ack_msg(msg: kombu.Message, ack_threadq: Optional[queue.Queue] = None) -> None:
+    """Adds a message to the ack queue to be ack'ed by the fetch thread.
+
+    By default, this uses the ack queue of the fetch thread that received the
+    message.
+    """
+    if ack_threadq is None:
+        ack_threadq = getattr(msg, ACK_THREADQ_ATTR, None)
+
+    if ack_threadq is None:
+        raise ValueError("message was not received through fetch_msgs")
+
+    capture.record_ack(msg)
     ack_threadq.put(msg)
 
 
+def ack_msgs(conn: Connection, msgs: list[kombu.Message]) -> None:
+    """Acks a batch of messages in as few broker calls as possible.
+
+    AMQP acks the highest delivery tag with multiple=True, which assumes that
+    every earlier message delivered on the channel is also within the batch
+    (as is the case for messages fetched by _fetch_thread). SQS deletes
+    messages in batches of 10 per queue. Other transports ack each message.
+    """
+    if len(msgs) == 0:
+        return
+
+    driver_type = conn.transport.driver_type
+
+    if driver_type == "amqp" and len(msgs) > 1:
+        # the other messages of the batch stay un-acked in kombu's eyes, but
+        # they're never acked again (see _fetch_thread)
+        last = max(msgs, key=lambda msg: msg.delivery_tag)
+        last.ack(multiple=True)
+
+    elif driver_type == "sqs" and len(msgs) > 1:
+        # batches can mix queues when stealing from other shards
+        by_queue = defaultdict(list)
+        for msg in msgs:
+            by_queue[msg.delivery_info["sqs_queue"]].append(msg)
+
+        for queue_msgs in by_queue.values():
+            for i in range(0, len(queue_msgs), SQS_BATCH_SIZE):
+                _ack_msgs_sqs(queue_msgs[i : i + SQS_BATCH_SIZE])
+
+    else:
+        for msg in msgs:
+            msg.ack()
+
+
+def _ack_msgs_sqs(msgs: list[kombu.Message]) -> None:
+    """Deletes up to SQS_BATCH_SIZE messages from a single SQS queue."""
+    channel = msgs[0].channel
+    delivery_info = msgs[0].delivery_info
+    queue = channel.canonical_queue_name(delivery_info["routing_key"])
+
+    resp = channel.sqs(queue=queue).delete_message_batch(
+        QueueUrl=delivery_info["sqs_queue"],
+        Entries=[
+            dict(
+                Id=str(i),
+                ReceiptHandle=msg.delivery_info["sqs_message"]["ReceiptHandle"],
+            )
+            for (i, msg) in enumerate(msgs)
+        ],
+    )
+
+    failed = {int(entry["Id"]) for entry in resp.get("Failed", [])}
+    if failed:
+        logger.warning(f"Retrying {len(failed)} failed SQS deletes one by one")
+
+    for (i, msg) in enumerate(msgs):
+        if i in failed:
+            msg.ack()  # deletes the message on its own
+        else:
+            # only forgets the delivery, which the batch already deleted
+            channel.qos.ack(msg.delivery_tag)
+
+
 def purge_queue(queue_url: str, queue_name: str) -> None:
     """Removes all messages from a given queue."""
-    with Connection(queue_url) as conn:
+    with connect(queue_url) as conn:
         queue = conn.SimpleQueue(queue_name)
         queue.clear()
 
@@ -262,6 +809,10 @@ def num_msgs(
         )
     elif queue_url.startswith("sqs://"):
         return num_msgs_sqs(queue_url, queue_name)
+    elif queue_url.startswith("sqlite://"):
+        return num_msgs_sqlite(queue_url, queue_name)
+    elif queue_url.startswith(LOCAL_SCHEMES):
+        return num_msgs_local(queue_url, queue_name)
     else:
         raise ValueError(f"unrecognized queue url: {queue_url}")
 
@@ -333,3 +884,22 @@ def num_msgs_sqs(queue_url: str, queue_name: str, connect_timeout: int = 60) ->
         return int(resp["Attributes"]["ApproximateNumberOfMessages"]) + int(
             resp["Attributes"]["ApproximateNumberOfMessagesNotVisible"]
         )
+
+
+def num_msgs_sqlite(queue_url: str, queue_name: str) -> int:
+    """Determines how many messages are left in a SQLite-backed queue.
+
+    This INCLUDES messages that are not currently ready for delivery (i.e.,
+    un-acked messages).
+    """
+    return sqlite.num_msgs(local_path(queue_url), queue_name)
+
+
+def num_msgs_local(queue_url: str, queue_name: str) -> int:
+    """Determines how many messages are left in a memory or filesystem queue.
+
+    These transports hold un-acked messages within the consuming connection,
+    so this only counts messages that are ready for delivery.
+    """
+    with connect(queue_url) as conn:
+        return conn.SimpleQueue(queue_name).qsize()
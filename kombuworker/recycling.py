@@ -0,0 +1,127 @@
+"""Recycling workers before leaky task code exhausts a node's memory.
+
+A RecyclePolicy is checked by poll between tasks. Once a worker has run too
+many tasks, grown past an RSS ceiling or run for too long, poll acks its
+current task and returns instead of fetching another one. supervise keeps a
+pool of worker processes running, replacing each one that's recycled.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+import resource
+import multiprocessing
+from typing import Any, Callable, Optional
+
+from .log import logger
+
+
+# Exit code of worker processes that stopped to be recycled
+RECYCLE_EXIT_CODE = 3
+
+
+class RecyclePolicy:
+    """Limits on the lifetime of a worker.
+
+    Args:
+        max_tasks: The maximum number of tasks to run (None for no limit).
+        max_rss_mb: The resident memory ceiling in MiB (None for no limit).
+        max_wall_time: The maximum number of seconds to keep fetching tasks
+            (None for no limit). A task started before then runs to completion.
+    """
+
+    def __init__(
+        self,
+        max_tasks: Optional[int] = None,
+        max_rss_mb: Optional[float] = None,
+        max_wall_time: Optional[float] = None,
+    ):
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        self.max_wall_time = max_wall_time
+
+        self.num_tasks = 0
+        self.start_time = time.time()
+
+    def task_done(self) -> Optional[str]:
+        """Records a finished task, and returns why to recycle (if needed)."""
+        self.num_tasks += 1
+
+        if self.max_tasks is not None and self.num_tasks >= self.max_tasks:
+            return f"ran {self.num_tasks} tasks"
+
+        if self.max_rss_mb is not None:
+            rss_mb = rss_bytes() / 2**20
+            if rss_mb > self.max_rss_mb:
+                return f"RSS of {rss_mb:.0f} MiB exceeds {self.max_rss_mb} MiB"
+
+        return self.expired()
+
+    def expired(self) -> Optional[str]:
+        """Returns why to recycle if max_wall_time has passed (e.g., while idle)."""
+        if self.max_wall_time is not None:
+            elapsed = time.time() - self.start_time
+            if elapsed > self.max_wall_time:
+                return f"ran for {elapsed:.0f}s"
+
+        return None
+
+
+def rss_bytes() -> int:
+    """Measures the resident memory of this process.
+
+    Falls back to the peak RSS where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_worker(poll: Callable, args: tuple, kwargs: dict) -> None:
+    reason = poll(*args, **kwargs)
+    sys.exit(RECYCLE_EXIT_CODE if reason is not None else 0)
+
+
+def supervise(
+    poll: Callable[..., Optional[str]],
+    num_workers: int,
+    *args: Any,
+    check_interval: float = 1.0,
+    **kwargs: Any,
+) -> None:
+    """Runs poll in a pool of processes, replacing those that are recycled.
+
+    Workers that stop for any other reason (e.g., the queue ran dry) aren't
+    replaced. Returns once every worker has stopped.
+
+    Example:
+        supervise(ag.poll, 8, queue_url, "mytool", task_parser, max_rss_mb=2000)
+    """
+
+    def start_worker() -> multiprocessing.Process:
+        p = multiprocessing.Process(target=_run_worker, args=(poll, args, kwargs))
+        p.start()
+        return p
+
+    workers = [start_worker() for _ in range(num_workers)]
+
+    while workers:
+        time.sleep(check_interval)
+
+        running = list()
+        for p in workers:
+            if p.is_alive():
+                running.append(p)
+                continue
+
+            p.join()
+            if p.exitcode == RECYCLE_EXIT_CODE:
+                logger.info(f"Replacing recycled worker {p.pid}")
+                running.append(start_worker())
+
+        workers = running
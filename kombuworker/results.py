@@ -0,0 +1,268 @@
+"""Publishing task results and aggregating them as tasks complete.
+
+Workers publish one record per task to a results sub-queue, batching records
+into as few messages as possible. An Aggregator consumes those records to
+stream results and to track when a submitted set of tasks has finished. This
+doesn't rely on counting the messages left in the task queue, which includes
+in-flight tasks.
+"""
+from __future__ import annotations
+
+import time
+import threading
+from typing import Any, Optional, Iterable, Generator
+
+from kombu.simple import SimpleQueue
+
+from . import codec
+from . import queuetools as qt
+from .log import logger
+
+
+RESULTS_SUFFIX = "::results"
+
+
+def results_queue(queue_name: str) -> str:
+    """Names the results sub-queue for a task queue."""
+    return f"{queue_name}{RESULTS_SUFFIX}"
+
+
+class ResultPublisher:
+    """Publishes task records to a results queue in batches.
+
+    Records are sent by a background thread once batch_size of them
+    accumulate (or a failure is added), at most interval seconds after the
+    first of them was added, and whenever the publisher is flushed or closed.
+    Adding records never waits for the broker, so a broker outage can't hold
+    up a worker. Records that fail to publish are retried with the next
+    batch, keeping at most max_pending of them (dropping the oldest).
+    """
+
+    def __init__(
+        self,
+        queue_url: str,
+        queue_name: str,
+        batch_size: int = 1,
+        interval: float = 1.0,
+        max_pending: int = 100_000,
+    ):
+        self.queue_url = queue_url
+        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self._pending: list[dict] = list()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+
+        self._thread = threading.Thread(target=self._flush_periodically)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_result(self, task_id: str, result: Any, elapsed: float) -> None:
+        """Records the return value of a successful task.
+
+        Results that can't be encoded are published as their repr.
+        """
+        self._add(dict(id=task_id, ok=True, result=result, elapsed=elapsed))
+
+    def add_failure(self, task_id: str, exc: BaseException) -> None:
+        """Records a failed task, to be published right away."""
+        self._add(dict(id=task_id, ok=False, error=f"{type(exc).__name__}: {exc}"))
+        self._wake.set()
+
+    def _add(self, record: dict) -> None:
+        with self._lock:
+            self._pending.append(record)
+            full = len(self._pending) >= self.batch_size
+            self._drop_excess()
+
+        if full:
+            self._wake.set()
+
+    def _drop_excess(self) -> None:
+        """Drops the oldest pending records beyond max_pending (locked)."""
+        excess = len(self._pending) - self.max_pending
+        if excess > 0:
+            logger.warning(f"Dropping {excess} unpublished task results")
+            del self._pending[:excess]
+
+    def _try_flush(self) -> None:
+        """Flushes, logging (rather than raising) any failure."""
+        try:
+            self.flush()
+        except Exception as exc:
+            logger.warning(f"Cannot publish task results (will retry): {exc}")
+
+    def flush(self) -> None:
+        """Publishes all pending records as a single message.
+
+        The records are kept for the next flush if publishing fails.
+        """
+        with self._lock:
+            records, self._pending = self._pending, list()
+
+        if len(records) == 0:
+            return
+
+        try:
+            try:
+                (body,), content_type = codec.encode([records])
+            except (TypeError, ValueError):
+                records = [_encodable(record) for record in records]
+                (body,), content_type = codec.encode([records])
+
+            qt.insert_msgs(
+                self.queue_url, self.queue_name, [body], content_type=content_type
+            )
+        except Exception:
+            with self._lock:
+                self._pending = records + self._pending
+                self._drop_excess()
+            raise
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._try_flush()
+
+    def close(self) -> None:
+        """Stops the background thread and publishes any pending records.
+
+        This only logs failures to publish, so it's safe within error
+        handling.
+        """
+        self._closed.set()
+        self._wake.set()
+        self._thread.join()
+        self._try_flush()
+
+        if len(self._pending) > 0:
+            logger.error(f"Lost {len(self._pending)} unpublished task results")
+
+
+def _encodable(record: dict) -> dict:
+    """Replaces a result that can't be encoded with its repr."""
+    try:
+        codec.encode([record])
+        return record
+    except (TypeError, ValueError):
+        logger.warning(f"Task {record['id']} returned a result that can't be encoded")
+        return dict(record, result=repr(record.get("result")))
+
+
+class Aggregator:
+    """Consumes task records from a results queue.
+
+    Args:
+        queue_url: The url of the queue host.
+        queue_name: The name of the results queue.
+        task_ids: The tasks to track. Without these, the aggregator streams
+            records indefinitely (or until a timeout).
+        poll_interval: How long to wait for each new record message before
+            checking for completion or timeouts.
+    """
+
+    def __init__(
+        self,
+        queue_url: str,
+        queue_name: str,
+        task_ids: Optional[Iterable[str]] = None,
+        poll_interval: float = 1.0,
+    ):
+        self.queue_url = queue_url
+        self.queue_name = queue_name
+        self.poll_interval = poll_interval
+
+        self.results: dict[str, Any] = dict()
+        self.failures: dict[str, str] = dict()
+        self.pending: Optional[set[str]] = None if task_ids is None else set(task_ids)
+
+    @property
+    def done(self) -> bool:
+        """Whether every tracked task has succeeded."""
+        return self.pending is not None and len(self.pending) == 0
+
+    def stream(self, timeout: Optional[float] = None) -> Generator[dict, None, None]:
+        """Yields task records as they arrive.
+
+        Stops once every tracked task has succeeded, or once timeout seconds
+        pass. Records of failed tasks are yielded but don't complete a task,
+        since a redelivered task may still succeed.
+        """
+        end_time = None if timeout is None else time.time() + timeout
+
+        with qt.connect(self.queue_url) as conn:
+            queue = conn.SimpleQueue(self.queue_name)
+
+            while not self.done:
+                wait_time = self.poll_interval
+                if end_time is not None:
+                    wait_time = min(wait_time, end_time - time.time())
+                    if wait_time <= 0:
+                        return
+
+                try:
+                    msg = queue.get(block=True, timeout=wait_time)
+                except SimpleQueue.Empty:
+                    continue
+
+                records = codec.decode(msg)
+                for record in records:
+                    self._record(record)
+                msg.ack()
+
+                yield from records
+
+    @property
+    def failed(self) -> bool:
+        """Whether every unfinished tracked task has failed at least once."""
+        return (
+            self.pending is not None
+            and len(self.pending) > 0
+            and all(task_id in self.failures for task_id in self.pending)
+        )
+
+    def wait(
+        self, timeout: Optional[float] = None, wait_for_retries: bool = False
+    ) -> dict[str, Any]:
+        """Blocks until every tracked task succeeds and returns their results.
+
+        Unless wait_for_retries is set, this stops waiting once every
+        unfinished task has failed, rather than waiting for redeliveries.
+
+        Raises:
+            ValueError: if the aggregator isn't tracking any tasks.
+            RuntimeError: if the unfinished tasks have failed.
+            TimeoutError: if the tasks don't finish within the timeout.
+        """
+        if self.pending is None:
+            raise ValueError("no task ids to wait for")
+
+        for _ in self.stream(timeout=timeout):
+            if self.failed and not wait_for_retries:
+                break
+
+        if self.failed:
+            raise RuntimeError(f"{len(self.pending)} tasks failed: {self.failures}")
+
+        if not self.done:
+            raise TimeoutError(f"{len(self.pending)} tasks remain unfinished")
+
+        return self.results
+
+    def _record(self, record: dict) -> None:
+        task_id = record["id"]
+
+        if record["ok"]:
+            self.results[task_id] = record["result"]
+            self.failures.pop(task_id, None)
+            if self.pending is not None:
+                self.pending.discard(task_id)
+
+        elif task_id not in self.results:
+            logger.warning(f"Task {task_id} failed: {record['error']}")
+            self.failures[task_id] = record["error"]
@@ -0,0 +1,222 @@
+"""A durable local queue transport backed by SQLite.
+
+Messages live in a single table keyed by queue name. Fetching a message
+reserves it instead of removing it, and the row is only deleted once the
+message is acked. Reserved messages that are never acked (e.g., the worker
+crashed) become visible again after a visibility timeout, much like SQS.
+Messages published with a "not_before" property (a unix timestamp) stay
+invisible until that time.
+"""
+from __future__ import annotations
+
+import time
+import sqlite3
+import threading
+import contextlib
+from queue import Empty
+from typing import Iterator
+
+from kombu.transport import virtual, TRANSPORT_ALIASES
+from kombu.utils.json import dumps, loads
+
+
+DEFAULT_VISIBILITY_TIMEOUT = 3600  # seconds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    reserved_at REAL,
+    not_before REAL
+);
+CREATE INDEX IF NOT EXISTS messages_queue ON messages (queue, id);
+"""
+
+
+def connect(database: str, timeout: float = 60) -> sqlite3.Connection:
+    """Opens (and initializes if needed) a queue database."""
+    db = sqlite3.connect(
+        database, timeout=timeout, isolation_level=None, check_same_thread=False
+    )
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+
+    # databases created before delayed messages were supported
+    columns = [row[1] for row in db.execute("PRAGMA table_info(messages)")]
+    if "not_before" not in columns:
+        db.execute("ALTER TABLE messages ADD COLUMN not_before REAL")
+
+    return db
+
+
+@contextlib.contextmanager
+def transaction(db: sqlite3.Connection, immediate: bool = False) -> Iterator[None]:
+    """Runs statements within a transaction, rolling it back on errors.
+
+    For connections in autocommit mode (opened with isolation_level=None).
+    Immediate transactions take the write lock as they begin.
+    """
+    db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def num_msgs(database: str, queue_name: str) -> int:
+    """Counts all messages in a queue, including reserved (un-acked) ones."""
+    db = connect(database)
+    try:
+        (count,) = db.execute(
+            "SELECT COUNT(*) FROM messages WHERE queue = ?", (queue_name,)
+        ).fetchone()
+    finally:
+        db.close()
+
+    return count
+
+
+def queue_sizes(database: str, prefix: str = "") -> dict[str, int]:
+    """Counts all messages of every queue whose name starts with a prefix."""
+    db = connect(database)
+    try:
+        rows = db.execute(
+            "SELECT queue, COUNT(*) FROM messages"
+            " WHERE substr(queue, 1, ?) = ? GROUP BY queue",
+            (len(prefix), prefix),
+        ).fetchall()
+    finally:
+        db.close()
+
+    return dict(rows)
+
+
+class Channel(virtual.Channel):
+    """SQLite Channel."""
+
+    def __init__(self, connection, **kwargs):
+        options = connection.client.transport_options
+        self.database = options.get("database", "kombuworker.sqlite")
+        self.visibility_timeout = options.get(
+            "visibility_timeout", DEFAULT_VISIBILITY_TIMEOUT
+        )
+        self._db = connect(self.database)
+        self._db_lock = threading.Lock()
+
+        super().__init__(connection, **kwargs)
+
+    def _visible_clause(self) -> tuple[str, tuple[float, float]]:
+        now = time.time()
+        return (
+            "(reserved_at IS NULL OR reserved_at < ?)"
+            " AND (not_before IS NULL OR not_before <= ?)",
+            (now - self.visibility_timeout, now),
+        )
+
+    def _put(self, queue, message, **kwargs):
+        not_before = message.get("properties", {}).get("not_before")
+        with self._db_lock:
+            self._db.execute(
+                "INSERT INTO messages (queue, payload, not_before) VALUES (?, ?, ?)",
+                (queue, dumps(message), not_before),
+            )
+
+    def _get(self, queue, timeout=None):
+        visible, params = self._visible_clause()
+        with self._db_lock, transaction(self._db, immediate=True):
+            row = self._db.execute(
+                f"SELECT id, payload FROM messages"
+                f" WHERE queue = ? AND {visible} ORDER BY id LIMIT 1",
+                (queue, *params),
+            ).fetchone()
+
+            if row is not None:
+                self._db.execute(
+                    "UPDATE messages SET reserved_at = ? WHERE id = ?",
+                    (time.time(), row[0]),
+                )
+
+        if row is None:
+            raise Empty()
+
+        msg_id, payload = row
+        payload = loads(payload)
+        payload["properties"]["delivery_info"]["sqlite_id"] = msg_id
+
+        return payload
+
+    def _size(self, queue):
+        visible, params = self._visible_clause()
+        with self._db_lock:
+            (count,) = self._db.execute(
+                f"SELECT COUNT(*) FROM messages WHERE queue = ? AND {visible}",
+                (queue, *params),
+            ).fetchone()
+
+        return count
+
+    def _purge(self, queue):
+        visible, params = self._visible_clause()
+        with self._db_lock:
+            cursor = self._db.execute(
+                f"DELETE FROM messages WHERE queue = ? AND {visible}",
+                (queue, *params),
+            )
+
+        return cursor.rowcount
+
+    def _delete(self, queue, *args, **kwargs):
+        with self._db_lock:
+            self._db.execute("DELETE FROM messages WHERE queue = ?", (queue,))
+
+    def _has_queue(self, queue, **kwargs):
+        return True
+
+    def _restore(self, message):
+        """Makes a reserved message visible again instead of re-inserting it."""
+        msg_id = message.delivery_info.get("sqlite_id")
+        if msg_id is None:
+            return super()._restore(message)
+
+        with self._db_lock:
+            self._db.execute(
+                "UPDATE messages SET reserved_at = NULL WHERE id = ?", (msg_id,)
+            )
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        msg_id = self.qos.get(delivery_tag).delivery_info.get("sqlite_id")
+        if msg_id is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+
+        super().basic_ack(delivery_tag)
+
+    def close(self):
+        super().close()
+        self._db.close()
+
+
+class Transport(virtual.Transport):
+    """SQLite Transport."""
+
+    Channel = Channel
+
+    # exchange/binding state is per-process, like the filesystem transport
+    global_state = virtual.BrokerState()
+
+    default_port = 0
+    driver_type = "sqlite"
+    driver_name = "sqlite3"
+
+    def __init__(self, client, **kwargs):
+        super().__init__(client, **kwargs)
+        self.state = self.global_state
+
+    def driver_version(self):
+        return sqlite3.sqlite_version
+
+
+TRANSPORT_ALIASES.setdefault("sqlite", "kombuworker.sqlite:Transport")
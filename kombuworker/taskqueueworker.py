@@ -3,23 +3,69 @@ from __future__ import annotations
 
 import sys
 import time
-import json
 import signal
-from typing import Union, Iterable, Generator
+import threading
+from typing import Callable, Union, Iterable, Optional, Generator
 
 from taskqueue.lib import jsonify
 from taskqueue.queueables import totask, FunctionTask, RegisteredTask
 
+from . import codec
+from . import capture
+from . import checkpoints
+from . import dedup
+from . import introspect
+from . import recycling
+from . import limits
 from . import queuetools as qt
 
 from .log import logger
 
 
-def insert_tasks(queue_url: str, queue_name: str, tasks: Iterable):
-    """Inserts tasks into a queue."""
+def insert_tasks(
+    queue_url: str,
+    queue_name: str,
+    tasks: Iterable,
+    delay: Optional[float] = None,
+    not_before: Optional[float] = None,
+    dedup_index: Optional[dedup.Index] = None,
+    raw_json: bool = False,
+):
+    """Inserts tasks into a queue.
+
+    Delivery can be postponed by delay seconds, or until the not_before unix
+    timestamp (see queuetools.insert_msgs). With a dedup_index, tasks that
+    match a task that's still pending aren't inserted again (see dedup.Index).
+    With raw_json, payloads are published as raw JSON bodies that only newer
+    workers can read (see codec).
+    """
     payloads = [jsonify(totask(task).payload()) for task in tasks]
 
-    qt.insert_msgs(queue_url, queue_name, payloads)
+    dedup_ids = None
+    if dedup_index is not None:
+        keys = [dedup.content_key(payload) for payload in payloads]
+        pending = dedup_index.submit(keys)
+        new = [i for (i, pending_id) in enumerate(pending) if pending_id is None]
+        payloads = [payloads[i] for i in new]
+        dedup_ids = [keys[i] for i in new]
+
+    if not_before is not None:
+        delay = max(not_before - time.time(), 0)
+
+    try:
+        qt.insert_msgs(
+            queue_url,
+            queue_name,
+            payloads,
+            content_type=codec.JSON_CONTENT_TYPE if raw_json else None,
+            delay=delay,
+            dedup_ids=dedup_ids,
+        )
+    except Exception:
+        # forgets the keys of tasks that may not have been published
+        if dedup_index is not None and dedup_ids is not None:
+            dedup_index.discard(dedup_ids)
+        raise
 
 
 def fetch_tasks(
@@ -29,8 +75,13 @@ def fetch_tasks(
     max_waiting_period: int = 60,
     max_num_retries: int = 5,
     verbose: bool = False,
+    ack_batch_size: int = 1,
+    ack_interval: float = 1.0,
+    status: Optional[introspect.Status] = None,
+    recorder: Optional[capture.Recorder] = None,
+    stop_when: Optional[Callable[[], bool]] = None,
 ) -> Generator[Union[FunctionTask, RegisteredTask], None, None]:
-    """Fetches tasks from the queue."""
+    """Fetches tasks from the queue (see queuetools.fetch_msgs)."""
     it = qt.fetch_msgs(
         queue_url,
         queue_name,
@@ -38,11 +89,16 @@ def fetch_tasks(
         max_waiting_period=max_waiting_period,
         max_num_retries=max_num_retries,
         verbose=verbose,
+        ack_batch_size=ack_batch_size,
+        ack_interval=ack_interval,
+        status=status,
+        recorder=recorder,
+        stop_when=stop_when,
     )
 
     for message in it:
         try:
-            yield totask(json.loads(message.payload)), message
+            yield totask(codec.decode(message)), message
 
         except GeneratorExit:
             it.close()
@@ -56,48 +112,131 @@ def poll(
     max_waiting_period: int = 60,
     max_num_retries: int = 5,
     verbose: bool = False,
-) -> None:
-    """Fetches tasks and executes them."""
-    global KEEP_LOOPING
-    KEEP_LOOPING = True  # type: ignore[name-defined]
+    ack_batch_size: int = 1,
+    ack_interval: float = 1.0,
+    rate_limit: Optional[float] = None,
+    rate_burst: int = 1,
+    max_concurrent: Optional[int] = None,
+    limit_dir: Optional[str] = None,
+    checkpoint_store: Optional[checkpoints.Store] = None,
+    introspect_address: Optional[str] = None,
+    max_tasks: Optional[int] = None,
+    max_rss_mb: Optional[float] = None,
+    max_wall_time: Optional[float] = None,
+    capture_path: Optional[str] = None,
+    dedup_index: Optional[dedup.Index] = None,
+) -> Optional[str]:
+    """Fetches tasks and executes them.
+
+    Setting ack_batch_size above 1 coalesces acks (see queuetools.fetch_msgs).
+    Task execution can be rate-limited and capped per queue, within this
+    process or across every process sharing a limit_dir (see limits.Limiter).
+    With a checkpoint_store, tasks can save their progress through
+    checkpoints.current() and resume from it if they're redelivered.
+    With an introspect_address, the worker serves its live state and thread
+    stacks (see introspect.serve).
+
+    The worker is recycled (returning the reason) after max_tasks tasks, once
+    its RSS exceeds max_rss_mb or once max_wall_time seconds pass (even while
+    idle), after acking its current task (see recycling.RecyclePolicy).
+    With a capture_path, the message stream is recorded for replay (see
+    capture.replay). Completed tasks are removed from the dedup_index.
+    """
+    # per call, so workers can poll in several threads of one process
+    keep_looping = threading.Event()
+    keep_looping.set()
 
     def sigint_handler(signum, frame):
-        global KEEP_LOOPING
-        if KEEP_LOOPING:
+        if keep_looping.is_set():
             logger.info(
                 "Interrupted."
                 " Exiting after this task completes."
                 " Interrupt again to exit now.",
             )
-            KEEP_LOOPING = False
+            keep_looping.clear()
         else:
             sys.exit()
 
-    prev_sigint_handler = signal.getsignal(signal.SIGINT)
-    signal.signal(signal.SIGINT, sigint_handler)
+    # signal handlers can only be installed from the main thread
+    handle_signals = threading.current_thread() is threading.main_thread()
+    if handle_signals:
+        prev_sigint_handler = signal.getsignal(signal.SIGINT)
+        signal.signal(signal.SIGINT, sigint_handler)
 
-    it = fetch_tasks(
-        queue_url,
-        queue_name,
-        init_waiting_period=init_waiting_period,
-        max_waiting_period=max_waiting_period,
-        max_num_retries=max_num_retries,
-        verbose=verbose,
+    policy = recycling.RecyclePolicy(
+        max_tasks=max_tasks, max_rss_mb=max_rss_mb, max_wall_time=max_wall_time
     )
+    recycle_reason = None
+
+    status = introspect.Status(queue_name)
+    server = None
+    recorder = None
+    it = None
+    try:
+        if introspect_address is not None:
+            server = introspect.serve(introspect_address)
+
+        recorder = None if capture_path is None else capture.Recorder(capture_path)
+
+        it = fetch_tasks(
+            queue_url,
+            queue_name,
+            init_waiting_period=init_waiting_period,
+            max_waiting_period=max_waiting_period,
+            max_num_retries=max_num_retries,
+            verbose=verbose,
+            ack_batch_size=ack_batch_size,
+            ack_interval=ack_interval,
+            status=status,
+            recorder=recorder,
+            # lets an idle worker recycle once max_wall_time passes
+            stop_when=lambda: policy.expired() is not None,
+        )
+
+        limiter = limits.get_limiter(
+            queue_name,
+            rate=rate_limit,
+            burst=rate_burst,
+            max_concurrent=max_concurrent,
+            lock_dir=limit_dir,
+        )
+
+        while keep_looping.is_set():
+            try:
+                task, msg = next(it)
+
+                status.start_task(str(msg.delivery_tag))
+                start_time = time.time()
+                with limiter, checkpoints.activate(checkpoint_store, msg):
+                    task.execute()
+                elapsed = time.time() - start_time
+
+                qt.ack_msg(msg)
+                if checkpoint_store is not None:
+                    checkpoint_store.delete(checkpoints.msg_key(msg))
+                if dedup_index is not None:
+                    dedup_index.complete(dedup.content_key(jsonify(codec.decode(msg))))
+                status.finish_task()
+                logger.info(f"Task successfully executed in {elapsed:.2f}s")
+
+                recycle_reason = policy.task_done()
+                if recycle_reason is not None:
+                    logger.info(f"Recycling worker: {recycle_reason}")
+                    break
+
+            except StopIteration:
+                recycle_reason = policy.expired()
+                break
+    finally:
+        # also when a task fails or the worker is interrupted
+        if handle_signals:
+            signal.signal(signal.SIGINT, prev_sigint_handler)
+        if it is not None:
+            it.close()
+        status.close()
+        if server is not None:
+            introspect.stop(server)
+        if recorder is not None:
+            recorder.close()
 
-    while KEEP_LOOPING:  # type: ignore[name-defined]
-        try:
-            task, msg = next(it)
-
-            start_time = time.time()
-            task.execute()
-            elapsed = time.time() - start_time
-
-            qt.ack_msg(msg)
-            logger.info(f"Task successfully executed in {elapsed:.2f}s")
-
-        except StopIteration:
-            break
-
-    signal.signal(signal.SIGINT, prev_sigint_handler)
-    it.close()
+    return recycle_reason
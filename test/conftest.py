@@ -57,6 +57,17 @@ def SQSurl():
     kill_subprocess(p)
 
 
+@pytest.fixture(params=["memory", "filesystem", "sqlite"])
+def localurl(request, tmp_path):
+    """A broker-free local queue url (no docker needed)."""
+    if request.param == "memory":
+        return "memory://"
+    elif request.param == "filesystem":
+        return f"filesystem://{tmp_path}/queue"
+    else:
+        return f"sqlite://{tmp_path}/queue.db"
+
+
 def kill_subprocess(p: subprocess.Popen) -> None:
     # Being a bit obsessive here
     retries = 10
@@ -0,0 +1,49 @@
+"""Tests for kombuworker/admin.py"""
+import pytest
+
+from kombuworker import admin
+from kombuworker import queuetools as qt
+import utils
+
+
+def fill_queues(queue_url):
+    names = ["pytest_admin::a", "pytest_admin::b", "pytest_other"]
+    for (i, name) in enumerate(names):
+        utils.clear_queue(queue_url, name)
+        qt.insert_msgs(queue_url, name, ["task"] * (i + 1))
+
+    return names
+
+
+def test_list_and_count(localurl):
+    fill_queues(localurl)
+
+    assert admin.list_queues(localurl, "pytest_admin::") == [
+        "pytest_admin::a",
+        "pytest_admin::b",
+    ]
+    assert admin.count_queues(localurl, "pytest_admin::") == {
+        "pytest_admin::a": 1,
+        "pytest_admin::b": 2,
+    }
+
+
+def test_purge_and_delete(localurl):
+    names = fill_queues(localurl)
+
+    assert admin.purge_queues(localurl, "pytest_admin::a") == ["pytest_admin::a"]
+    assert admin.count_queues(localurl, "pytest_admin::") == {names[1]: 2}
+
+    assert admin.delete_queues(localurl, "pytest_") == names[1:]
+    assert admin.list_queues(localurl, "pytest_") == []
+
+
+def test_purge_and_delete_require_prefix(localurl):
+    names = fill_queues(localurl)
+
+    with pytest.raises(ValueError):
+        admin.purge_queues(localurl, "")
+    with pytest.raises(ValueError):
+        admin.delete_queues(localurl, prefix="")
+
+    assert admin.list_queues(localurl, "pytest_") == sorted(names)
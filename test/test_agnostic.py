@@ -1,7 +1,14 @@
 """Tests for kombuworker/taskqueueworker.py"""
 import os
+import time
+import signal
+import threading
+
+import pytest
 
 from kombuworker import agnostic as ag
+from kombuworker import checkpoints
+from kombuworker import queuetools as qt
 import utils
 
 
@@ -76,3 +83,423 @@ def test_poll_side_effects(rabbitMQurl):
         os.remove(filename)
 
     os.rmdir(DUMMYDIR)
+
+
+def test_poll_side_effects_local(localurl):
+    tool_name = "pytest"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+
+    ids = range(10)
+    ag.insert_tasks(localurl, tool_name, [[i] for i in ids], [{} for i in ids])
+
+    def task_parser(i: int):
+        return lambda: dummy_side_effect(i)
+
+    ag.poll(
+        localurl,
+        tool_name,
+        task_parser,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+    )
+
+    for i in ids:
+        filename = os.path.join(DUMMYDIR, str(i))
+        assert os.path.exists(filename), f"{filename} doesn't exist"
+        os.remove(filename)
+
+    os.rmdir(DUMMYDIR)
+
+
+def test_poll_threads_local(localurl):
+    """Workers for different sub-queues can poll in threads of one process."""
+    tool_names = ["pytest_thread0", "pytest_thread1"]
+    done = {tool_name: list() for tool_name in tool_names}
+    for tool_name in tool_names:
+        utils.clear_queue(localurl, ag.parse_queue(localurl, tool_name).name)
+        ag.insert_tasks(localurl, tool_name, [[i] for i in range(3)], [{}] * 3)
+
+    prev_handler = signal.getsignal(signal.SIGINT)
+    errors = list()
+
+    def run(tool_name):
+        try:
+            ag.poll(
+                localurl,
+                tool_name,
+                lambda i: lambda: done[tool_name].append(i),
+                init_waiting_period=0.01,
+                max_waiting_period=0.1,
+            )
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in tool_names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert all(sorted(done[tool_name]) == [0, 1, 2] for tool_name in tool_names)
+    assert signal.getsignal(signal.SIGINT) is prev_handler
+
+
+def test_results_local(localurl):
+    tool_name = "pytest"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+    utils.clear_queue(q.url, f"{q.name}::results")
+
+    ids = range(10)
+    task_ids = ag.insert_tasks(
+        localurl, tool_name, [[i] for i in ids], [{} for i in ids]
+    )
+
+    def task_parser(i: int):
+        return lambda: i * 2
+
+    ag.poll(
+        localurl,
+        tool_name,
+        task_parser,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        publish_results=True,
+        results_batch_size=4,
+    )
+
+    aggregator = ag.aggregate(localurl, tool_name, task_ids, poll_interval=0.1)
+    results = aggregator.wait(timeout=10)
+
+    assert results == {task_id: i * 2 for (task_id, i) in zip(task_ids, ids)}
+
+
+def test_results_failure_local(localurl):
+    tool_name = "pytest_failure"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+    utils.clear_queue(q.url, f"{q.name}::results")
+
+    task_id = ag.insert_task(localurl, tool_name)
+
+    def task_parser():
+        def fn():
+            raise RuntimeError("boom")
+
+        return fn
+
+    with pytest.raises(RuntimeError):
+        ag.poll(localurl, tool_name, task_parser, publish_results=True)
+
+    aggregator = ag.aggregate(localurl, tool_name, [task_id], poll_interval=0.1)
+    with pytest.raises(RuntimeError):
+        aggregator.wait()
+
+    assert aggregator.failures == {task_id: "RuntimeError: boom"}
+
+
+def test_results_unencodable_local(localurl):
+    """Results that can't be encoded don't keep tasks from being acked."""
+    tool_name = "pytest_unencodable"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+    utils.clear_queue(q.url, f"{q.name}::results")
+
+    task_ids = ag.insert_tasks(localurl, tool_name, [[0], [1]], [{}, {}])
+
+    ag.poll(
+        localurl,
+        tool_name,
+        lambda i: lambda: object() if i == 0 else i,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        publish_results=True,
+        results_batch_size=2,
+    )
+
+    results = ag.aggregate(localurl, tool_name, task_ids, poll_interval=0.1).wait(
+        timeout=5
+    )
+    assert results[task_ids[0]].startswith("<object object")
+    assert results[task_ids[1]] == 1
+    assert utils.count_msgs(q.url, q.name) == 0
+
+
+def test_affinity_shards_local(localurl):
+    tool_name = "pytest_shards"
+    num_shards = 4
+    q = ag.parse_queue(localurl, tool_name)
+
+    ag.purge_queue(localurl, tool_name, num_shards=num_shards)
+
+    ids = list(range(20))
+    affinity_keys = [i // 5 for i in ids]
+    ag.insert_tasks(
+        localurl,
+        tool_name,
+        [[i] for i in ids],
+        [{} for i in ids],
+        affinity_keys=affinity_keys,
+        num_shards=num_shards,
+    )
+
+    # tasks with the same key share a shard
+    for key in set(affinity_keys):
+        shard = ag.affinity_shard(key, num_shards)
+        assert qt.num_msgs(localurl, ag.shard_queue(q.name, shard)) > 0
+
+    home_shard = ag.affinity_shard(0, num_shards)
+    home_ids = [
+        i
+        for (i, key) in zip(ids, affinity_keys)
+        if ag.affinity_shard(key, num_shards) == home_shard
+    ]
+
+    executed = list()
+
+    def task_parser(i: int):
+        return lambda: executed.append(i)
+
+    ag.poll(
+        localurl,
+        tool_name,
+        task_parser,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        num_shards=num_shards,
+        home_shard=home_shard,
+    )
+
+    assert sorted(executed) == ids
+    # the home shard's tasks run before any are stolen
+    assert sorted(executed[: len(home_ids)]) == home_ids
+
+
+def test_not_before_local(localurl):
+    tool_name = "pytest_delay"
+    utils.clear_queue(localurl, tool_name)
+
+    start_time = time.time()
+    ag.insert_tasks(localurl, tool_name, [[1]], [{}], not_before=start_time + 0.5)
+
+    executed = list()
+
+    def task_parser(i: int):
+        return lambda: executed.append(time.time() - start_time)
+
+    ag.poll(
+        localurl,
+        tool_name,
+        task_parser,
+        init_waiting_period=0.1,
+        max_waiting_period=0.2,
+        max_num_retries=6,
+    )
+
+    assert len(executed) == 1 and executed[0] >= 0.5
+
+
+class TwoPhaseTask:
+    def __init__(self, i, events):
+        self.i = i
+        self.events = events
+
+    def prepare(self):
+        self.events.append(("prepare", self.i, time.time()))
+        time.sleep(0.1)
+
+    def run(self):
+        time.sleep(0.1)
+        self.events.append(("run", self.i, time.time()))
+        return self.i
+
+
+def test_pipeline_local(localurl):
+    tool_name = "pytest_pipeline"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+
+    ids = range(4)
+    ag.insert_tasks(localurl, tool_name, [[i] for i in ids], [{} for i in ids])
+
+    events = list()
+
+    def task_parser(i: int):
+        return TwoPhaseTask(i, events)
+
+    ag.poll(
+        localurl,
+        tool_name,
+        task_parser,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        pipeline=True,
+    )
+
+    run_ends = sorted(t for (kind, _, t) in events if kind == "run")
+    prepare_starts = sorted(t for (kind, _, t) in events if kind == "prepare")
+    assert len(run_ends) == 4
+
+    # each task after the first was prepared while the one before it ran
+    assert all(start < end for (start, end) in zip(prepare_starts[1:], run_ends))
+    assert utils.count_msgs(q.url, q.name) == 0
+
+
+def test_pipeline_prepare_failure_local(localurl):
+    tool_name = "pytest_pipeline_failure"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+    ag.insert_task(localurl, tool_name)
+
+    class FailingTask:
+        def prepare(self):
+            raise IOError("inputs unavailable")
+
+        def run(self):
+            pass
+
+    with pytest.raises(IOError):
+        ag.poll(localurl, tool_name, FailingTask, pipeline=True)
+
+    # released for redelivery
+    assert utils.count_msgs(q.url, q.name) == 1
+
+
+def test_run_attribute_local(localurl):
+    """Tasks with a run attribute but no prepare are still called."""
+    tool_name = "pytest_run_attribute"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+    ag.insert_task(localurl, tool_name)
+
+    calls = list()
+
+    class CallableTask:
+        run = "not a phase"
+
+        def __call__(self):
+            calls.append("call")
+
+    ag.poll(
+        localurl,
+        tool_name,
+        CallableTask,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+    )
+
+    assert calls == ["call"]
+
+
+def test_pipeline_parser_failure_local(localurl):
+    tool_name = "pytest_pipeline_parser"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+    ag.insert_tasks(localurl, tool_name, [[i] for i in range(3)], [{}] * 3)
+
+    done = list()
+
+    def task_parser(i):
+        if i == 1:
+            raise ValueError("bad task")
+        return lambda: done.append(i)
+
+    prev_handler = signal.getsignal(signal.SIGINT)
+    with pytest.raises(ValueError):
+        ag.poll(
+            localurl,
+            tool_name,
+            task_parser,
+            init_waiting_period=0.01,
+            max_waiting_period=0.1,
+            pipeline=True,
+        )
+
+    # cleaned up, releasing the failed task (and any prefetched one)
+    assert signal.getsignal(signal.SIGINT) is prev_handler
+    assert utils.count_msgs(q.url, q.name) == 3 - len(done)
+
+
+def test_completion_failure_local(localurl, tmp_path):
+    tool_name = "pytest_completion_failure"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+    ag.insert_tasks(localurl, tool_name, [[0]], [{}])
+
+    class FailingStore(checkpoints.DirectoryStore):
+        def delete(self, key):
+            raise OSError("store unavailable")
+
+    prev_handler = signal.getsignal(signal.SIGINT)
+    num_threads = threading.active_count()
+    with pytest.raises(OSError):
+        ag.poll(
+            localurl,
+            tool_name,
+            lambda i: lambda: None,
+            init_waiting_period=0.01,
+            max_waiting_period=0.1,
+            publish_results=True,
+            checkpoint_store=FailingStore(str(tmp_path / "checkpoints")),
+        )
+
+    # cleaned up after the task ran (and was acked)
+    assert signal.getsignal(signal.SIGINT) is prev_handler
+    assert threading.active_count() == num_threads
+
+
+def test_pipeline_prepare_limited_local(localurl, tmp_path):
+    """Preparing counts against limits and sees the task's checkpoint."""
+    tool_name = "pytest_pipeline_limited"
+    q = ag.parse_queue(localurl, tool_name)
+
+    utils.clear_queue(q.url, q.name)
+    ids = range(3)
+    ag.insert_tasks(localurl, tool_name, [[i] for i in ids], [{} for i in ids])
+
+    events = list()
+    checkpointed = list()
+
+    class CheckedTask(TwoPhaseTask):
+        def prepare(self):
+            checkpointed.append(checkpoints.current() is not None)
+            super().prepare()
+            self.events.append(("prepared", self.i, time.time()))
+
+        def run(self):
+            self.events.append(("running", self.i, time.time()))
+            super().run()
+
+    ag.poll(
+        localurl,
+        tool_name,
+        lambda i: CheckedTask(i, events),
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        max_concurrent=1,
+        checkpoint_store=checkpoints.DirectoryStore(str(tmp_path / "checkpoints")),
+        pipeline=True,
+    )
+
+    assert checkpointed == [True] * 3
+
+    # with one slot, no task prepares while another runs
+    spans = dict()
+    for (kind, _, t) in sorted(events, key=lambda event: event[2]):
+        spans.setdefault(kind, list()).append(t)
+    intervals = sorted(
+        list(zip(spans["prepare"], spans["prepared"]))
+        + list(zip(spans["running"], spans["run"]))
+    )
+    assert all(end <= start for ((_, end), (start, _)) in zip(intervals, intervals[1:]))
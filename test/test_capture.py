@@ -0,0 +1,60 @@
+"""Tests for kombuworker/capture.py"""
+import time
+
+from kombuworker import agnostic as ag
+from kombuworker import capture
+from kombuworker import queuetools as qt
+import utils
+
+
+def sleep_parser(duration):
+    def fn():
+        time.sleep(duration)
+
+    return fn
+
+
+def test_capture_and_replay(localurl, tmp_path):
+    tool_name = "pytest_capture"
+    queue_name = ag.parse_queue(localurl, tool_name).name
+    utils.clear_queue(localurl, queue_name)
+    ag.insert_tasks(localurl, tool_name, [[0.01], [0.02], [0.03]], [{}] * 3)
+
+    path = str(tmp_path / "run.capture")
+    kwargs = dict(init_waiting_period=0.01, max_waiting_period=0.1)
+    ag.poll(localurl, tool_name, sleep_parser, capture_path=path, **kwargs)
+
+    msgs = capture.read(path)
+    assert len(msgs) == 3
+    assert all(msg.latency >= 0.01 for msg in msgs)
+
+    # replayed messages parse the same way
+    assert capture.replay(path, localurl, queue_name, speedup=10) == 3
+    replay_path = str(tmp_path / "replay.capture")
+    ag.poll(localurl, tool_name, sleep_parser, capture_path=replay_path, **kwargs)
+
+    assert sorted(msg.body for msg in capture.read(replay_path)) == sorted(
+        msg.body for msg in msgs
+    )
+
+    comparison = capture.compare(path, replay_path)
+    assert comparison["baseline"]["num_acked"] == 3
+    assert comparison["ratio"]["num_acked"] == 1
+
+
+def test_append(localurl, tmp_path):
+    queue_name = "pytest_capture_append"
+    utils.clear_queue(localurl, queue_name)
+    path = str(tmp_path / "run.capture")
+
+    for payload in ["a", "b"]:
+        qt.insert_msgs(localurl, queue_name, [payload])
+        recorder = capture.Recorder(path)
+        with qt.Consumer(localurl, queue_name, recorder=recorder) as consumer:
+            msg = next(iter(consumer))
+            consumer.ack(msg)
+        recorder.close()
+
+    msgs = capture.read(path)
+    assert len(msgs) == 2
+    assert all(msg.ack_time is not None for msg in msgs)
@@ -0,0 +1,73 @@
+"""Tests for kombuworker/checkpoints.py"""
+import pytest
+
+from kombuworker import agnostic as ag
+from kombuworker import checkpoints
+import utils
+
+
+@pytest.fixture(params=["directory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "directory":
+        return checkpoints.DirectoryStore(str(tmp_path / "checkpoints"))
+    else:
+        return checkpoints.SQLiteStore(str(tmp_path / "checkpoints.db"))
+
+
+def test_store(store):
+    checkpoint = checkpoints.Checkpoint(store, "key")
+    assert checkpoint.load(default=0) == 0
+
+    checkpoint.save({"done": [1, 2]})
+    assert checkpoint.load() == {"done": [1, 2]}
+
+    checkpoint.clear()
+    assert store.get("key") is None
+
+
+def test_resume_local(localurl, store):
+    tool_name = "pytest_checkpoint"
+    utils.clear_queue(localurl, tool_name)
+
+    ag.insert_task(localurl, tool_name, 10)
+
+    processed = list()
+    keys = list()
+    crash_at = [5]
+
+    def task_parser(num_steps: int):
+        def fn():
+            checkpoint = checkpoints.current()
+            keys.append(checkpoint.key)
+            for i in range(checkpoint.load(default=0), num_steps):
+                if i == crash_at[0]:
+                    raise RuntimeError("preempted")
+                processed.append(i)
+                checkpoint.save(i + 1)
+
+        return fn
+
+    kwargs = dict(
+        init_waiting_period=0.01, max_waiting_period=0.1, checkpoint_store=store
+    )
+    with pytest.raises(RuntimeError):
+        ag.poll(localurl, tool_name, task_parser, **kwargs)
+
+    crash_at[0] = None
+    ag.poll(localurl, tool_name, task_parser, **kwargs)
+
+    # resumed where the first attempt left off
+    assert processed == list(range(10))
+    # and cleared after the ack
+    assert keys[0] == keys[1]
+    assert store.get(keys[0]) is None
+    assert checkpoints.current() is None
+
+
+def test_incomplete_store():
+    class GetOnlyStore(checkpoints.Store):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyStore()
@@ -0,0 +1,87 @@
+"""Tests for kombuworker/codec.py"""
+import json
+
+import numpy as np
+
+from kombuworker import codec
+from kombuworker import agnostic as ag
+from kombuworker import queuetools as qt
+import utils
+
+QUEUENAME = "codec"
+
+
+def fetch_all(queue_url: str, queue_name: str) -> list:
+    """Decodes every message in a queue."""
+    decoded = list()
+    with qt.connect(queue_url) as conn:
+        queue = conn.SimpleQueue(queue_name)
+        while queue.qsize() > 0:
+            msg = queue.get_nowait()
+            decoded.append(codec.decode(msg))
+            msg.ack()
+
+    return decoded
+
+
+def test_json_roundtrip(localurl):
+    utils.clear_queue(localurl, QUEUENAME)
+
+    objs = [dict(args=[i], kwargs={"b": "c"}) for i in range(3)]
+    bodies, content_type = codec.encode(objs)
+    assert content_type == codec.JSON_CONTENT_TYPE
+
+    qt.insert_msgs(localurl, QUEUENAME, bodies, content_type=content_type)
+
+    decoded = fetch_all(localurl, QUEUENAME)
+    assert sorted(decoded, key=lambda obj: obj["args"]) == objs
+
+
+def test_legacy_str_payloads(localurl):
+    """Messages submitted as JSON strings are still parsed."""
+    utils.clear_queue(localurl, QUEUENAME)
+
+    qt.insert_msgs(localurl, QUEUENAME, ['{"args": [1], "kwargs": {}}'])
+
+    assert fetch_all(localurl, QUEUENAME) == [dict(args=[1], kwargs={})]
+
+
+def test_legacy_default(localurl):
+    """Plain tasks stay readable by workers that json.loads the payload."""
+    utils.clear_queue(localurl, QUEUENAME)
+    utils.clear_queue(localurl, f"{QUEUENAME}_raw")
+
+    ag.insert_tasks(localurl, QUEUENAME, [[1]], [{"b": "c"}])
+    ag.insert_tasks(localurl, f"{QUEUENAME}_raw", [[2]], [{}], raw_json=True)
+
+    with qt.connect(localurl) as conn:
+        msg = conn.SimpleQueue(QUEUENAME).get_nowait()
+        parsed = json.loads(msg.payload)
+        assert parsed["args"] == [1] and parsed["kwargs"] == {"b": "c"}
+        assert codec.decode(msg) == parsed
+        msg.ack()
+
+    (raw,) = fetch_all(localurl, f"{QUEUENAME}_raw")
+    assert raw["args"] == [2]
+
+
+def test_frames_roundtrip(localurl):
+    utils.clear_queue(localurl, QUEUENAME)
+
+    arr = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    objs = [
+        dict(args=[arr[:, 1]], kwargs={"raw": b"abc"}),
+        dict(args=[], kwargs={"plain": 1}),
+    ]
+    bodies, content_type = codec.encode(objs)
+    assert content_type == codec.FRAMES_CONTENT_TYPE
+
+    qt.insert_msgs(localurl, QUEUENAME, bodies, content_type=content_type)
+    first, second = sorted(
+        fetch_all(localurl, QUEUENAME), key=lambda obj: obj["args"] == []
+    )
+
+    np.testing.assert_array_equal(first["args"][0], arr[:, 1])
+    assert not first["args"][0].flags.writeable  # a view into the body
+    assert bytes(first["kwargs"]["raw"]) == b"abc"
+    assert second == objs[1]
@@ -0,0 +1,106 @@
+"""Tests for kombuworker/dag.py"""
+import pytest
+
+from kombuworker import agnostic as ag
+from kombuworker import dag
+from kombuworker import queuetools as qt
+import utils
+
+
+def test_store(tmp_path):
+    store = dag.SQLiteStore(str(tmp_path / "dag.db"))
+    child = dag.HeldTask("c", "memory://", "queue", b"body", None)
+
+    assert store.hold(child, ["a", "b"])
+    assert store.complete("a") == []
+    assert store.complete("a") == []  # completing twice counts once
+    assert store.complete("b") == [child]
+
+    store.mark_released(["c"])
+    assert store.num_held() == 0
+
+    # parents that already finished don't hold a task
+    assert not store.hold(dag.HeldTask("d", "memory://", "queue", b"", None), ["a"])
+    assert store.is_complete("a")
+    assert not store.is_complete("d")
+
+
+def test_store_rolls_back(tmp_path):
+    store = dag.SQLiteStore(str(tmp_path / "dag.db"))
+    for task_id in ["c", "d"]:
+        store.hold(dag.HeldTask(task_id, "memory://", "queue", b"", None), ["a"])
+
+    # the second child can't be deleted, after the first one was
+    with pytest.raises(Exception):
+        store.mark_released(["c", object()])
+
+    assert store.num_held() == 2
+    assert len(store.complete("a")) == 2
+
+
+def test_incomplete_store():
+    class HoldOnlyStore(dag.Store):
+        def hold(self, task, parents):
+            return True
+
+    with pytest.raises(TypeError):
+        HoldOnlyStore()
+
+
+def test_release_children(localurl, tmp_path):
+    store = dag.SQLiteStore(str(tmp_path / "dag.db"))
+    stage_a, stage_b = "pytest_dag_a", "pytest_dag_b"
+    for tool_name in [stage_a, stage_b]:
+        utils.clear_queue(localurl, ag.parse_queue(localurl, tool_name).name)
+
+    a_ids = ag.insert_tasks(localurl, stage_a, [[0], [1]], [{}, {}])
+    b_ids = ag.insert_tasks(
+        localurl,
+        stage_b,
+        [[10], [11]],
+        [{}, {}],
+        parents=[a_ids[:1], a_ids],
+        dag_store=store,
+    )
+    assert store.num_held() == 2
+    assert utils.count_msgs(localurl, ag.parse_queue(localurl, stage_b).name) == 0
+
+    done = list()
+
+    def task_parser(x):
+        return lambda: done.append(x)
+
+    kwargs = dict(init_waiting_period=0.01, max_waiting_period=0.1)
+    ag.poll(localurl, stage_a, task_parser, dag_store=store, **kwargs)
+    assert store.num_held() == 0
+
+    ag.poll(localurl, stage_b, task_parser, dag_store=store, **kwargs)
+    assert sorted(done) == [0, 1, 10, 11]
+    assert len(b_ids) == 2
+
+
+def test_duplicate_children(localurl, tmp_path):
+    store = dag.SQLiteStore(str(tmp_path / "dag.db"))
+    tool_name = "pytest_dag_duplicates"
+    q = ag.parse_queue(localurl, tool_name)
+    utils.clear_queue(q.url, q.name)
+
+    ag.insert_tasks(localurl, tool_name, [[0]], [{}], parents=[["a"]], dag_store=store)
+
+    # a worker died after publishing the child, and its parent was redelivered
+    (child,) = store.complete("a")
+    for _ in range(2):
+        qt.insert_msgs(q.url, q.name, [child.body], content_type=child.content_type)
+
+    done = list()
+    kwargs = dict(init_waiting_period=0.01, max_waiting_period=0.1)
+    ag.poll(localurl, tool_name, lambda x: lambda: done.append(x), **kwargs)
+    assert done == [0] * 2  # without the store, both run
+
+    for _ in range(2):
+        qt.insert_msgs(q.url, q.name, [child.body], content_type=child.content_type)
+
+    kwargs["dag_store"] = store
+    ag.poll(localurl, tool_name, lambda x: lambda: done.append(x), **kwargs)
+    assert done == [0] * 3
+    assert utils.count_msgs(q.url, q.name) == 0
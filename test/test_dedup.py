@@ -0,0 +1,111 @@
+"""Tests for kombuworker/dedup.py"""
+import pytest
+
+from kombuworker import agnostic as ag
+from kombuworker import dedup
+import utils
+
+
+def test_bloom_filter():
+    bloom = dedup.BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(str(i))
+
+    assert all(str(i) in bloom for i in range(1000))
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_index(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    index = dedup.Index(path, capacity=100)
+
+    assert index.submit(["a", "b", "a"], ["id_a", "id_b", "id_a2"]) == [
+        None,
+        None,
+        "id_a",
+    ]
+    index.close()
+
+    # persists, and completed tasks can be submitted again
+    index = dedup.Index(path, capacity=100)
+    index.complete("a")
+    assert index.submit(["a", "b"], ["id_a3", "id_b2"]) == [None, "id_b"]
+    assert len(index) == 2
+
+
+def test_index_rolls_back(tmp_path):
+    index = dedup.Index(str(tmp_path / "dedup.db"), capacity=100)
+
+    # the second row can't be written, after the first one was
+    with pytest.raises(Exception):
+        index.submit(["a", "b"], ["id_a", object()])
+
+    assert len(index) == 0
+    assert index.submit(["a"], ["id_a"]) == [None]
+    assert len(index) == 1
+
+
+def test_insert_and_complete(localurl, tmp_path):
+    tool_name = "pytest_dedup"
+    queue_name = ag.parse_queue(localurl, tool_name).name
+    utils.clear_queue(localurl, queue_name)
+    index = dedup.Index(str(tmp_path / "dedup.db"))
+
+    first = ag.insert_tasks(
+        localurl, tool_name, [[1], [2]], [{}, {}], dedup_index=index
+    )
+    again = ag.insert_tasks(
+        localurl, tool_name, [[2], [3]], [{}, {}], dedup_index=index
+    )
+    assert again[0] == first[1]
+
+    done = list()
+
+    def task_parser(x):
+        return lambda: done.append(x)
+
+    ag.poll(
+        localurl,
+        tool_name,
+        task_parser,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        dedup_index=index,
+    )
+
+    assert sorted(done) == [1, 2, 3]
+    assert len(index) == 0
+
+
+def test_keys_independent_of_batch(localurl, tmp_path):
+    """Tasks match whether or not their batch has binary arguments."""
+    tool_name = "pytest_dedup_batch"
+    queue_name = ag.parse_queue(localurl, tool_name).name
+    utils.clear_queue(localurl, queue_name)
+    index = dedup.Index(str(tmp_path / "dedup.db"))
+
+    (first,) = ag.insert_tasks(localurl, tool_name, [[1]], [{}], dedup_index=index)
+    again = ag.insert_tasks(
+        localurl, tool_name, [[1], [b"raw"]], [{}, {}], dedup_index=index
+    )
+
+    assert again[0] == first
+    assert len(index) == 2
+
+
+def test_failed_insert_forgets_keys(tmp_path):
+    index = dedup.Index(str(tmp_path / "dedup.db"))
+
+    # SQS can't delay messages this long, so nothing is published
+    with pytest.raises(ValueError):
+        ag.insert_tasks(
+            "sqs://localhost:9324",
+            "pytest_dedup_failure",
+            [[1]],
+            [{}],
+            delay=10**6,
+            dedup_index=index,
+        )
+
+    assert len(index) == 0
@@ -0,0 +1,139 @@
+"""Tests for kombuworker/introspect.py"""
+import os
+import json
+import time
+import socket
+import threading
+
+import requests
+
+from kombuworker import agnostic as ag
+from kombuworker import introspect
+from kombuworker import queuetools as qt
+import utils
+
+
+def test_status():
+    status = introspect.Status("pytest_status")
+    status.start_task("abc")
+    time.sleep(0.05)
+
+    (snapshot,) = [s for s in introspect.statuses() if s["name"] == "pytest_status"]
+    assert snapshot["msg_id"] == "abc"
+    assert snapshot["msg_age"] >= 0.05
+
+    status.finish_task()
+    assert status.snapshot()["msg_id"] is None
+    assert status.snapshot()["num_tasks"] == 1
+
+    status.close()
+    assert "pytest_status" not in [s["name"] for s in introspect.statuses()]
+
+
+def test_consumer_status(localurl):
+    queue_name = "pytest_introspect"
+    utils.clear_queue(localurl, queue_name)
+    qt.insert_msgs(localurl, queue_name, ["task"])
+
+    status = introspect.Status(queue_name)
+    with qt.Consumer(
+        localurl, queue_name, init_waiting_period=0.01, status=status
+    ) as consumer:
+        msg = next(iter(consumer))
+        time.sleep(0.1)
+        assert status.snapshot()["fetch_state"] == "WAIT"
+
+        consumer.ack(msg)
+    status.close()
+
+
+def test_serve_http():
+    server = introspect.serve("localhost:0")
+    host, port = server.server_address[:2]
+
+    try:
+        status = requests.get(f"http://{host}:{port}/status").json()
+        assert isinstance(status, list)
+
+        stacks = requests.get(f"http://{host}:{port}/stacks").text
+        assert "test_serve_http" in stacks
+
+        assert requests.get(f"http://{host}:{port}/other").status_code == 404
+    finally:
+        introspect.stop(server)
+
+    assert server.socket.fileno() == -1
+
+
+def test_serve_unix(tmp_path):
+    path = str(tmp_path / "worker.sock")
+    server = introspect.serve(path)
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(b"GET /status HTTP/1.0\r\n\r\n")
+            response = b""
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+
+        assert response.startswith(b"HTTP/1.0 200")
+        assert isinstance(json.loads(response.split(b"\r\n\r\n", 1)[1]), list)
+    finally:
+        introspect.stop(server)
+
+    assert server.socket.fileno() == -1
+    assert not os.path.exists(path)
+
+
+def test_serve_relative_unix(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    for address in ["worker.sock", "unix:other.sock"]:
+        server = introspect.serve(address)
+        path = address.split(":")[-1]
+        assert os.path.exists(path)
+
+        introspect.stop(server)
+        assert not os.path.exists(path)
+
+    server = introspect.serve("tcp:localhost:0")
+    assert server.server_address[1] > 0
+    introspect.stop(server)
+
+
+def test_poll_reports_task(localurl, tmp_path):
+    tool_name = "pytest_introspect_poll"
+    utils.clear_queue(localurl, tool_name)
+    ag.insert_task(localurl, tool_name, 0.5)
+
+    seen = list()
+
+    def task_parser(duration):
+        def fn():
+            time.sleep(duration)
+
+        return fn
+
+    def watch():
+        time.sleep(0.3)
+        seen.extend(s for s in introspect.statuses() if s["name"] == tool_name)
+
+    th = threading.Thread(target=watch)
+    th.start()
+    ag.poll(
+        localurl,
+        tool_name,
+        task_parser,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        introspect_address=str(tmp_path / "worker.sock"),
+    )
+    th.join()
+
+    (snapshot,) = seen
+    assert snapshot["msg_id"] is not None
+    assert snapshot["msg_age"] > 0
@@ -0,0 +1,115 @@
+"""Tests for kombuworker/limits.py"""
+import time
+import threading
+import multiprocessing
+
+import pytest
+
+from kombuworker import limits
+from kombuworker import agnostic as ag
+import utils
+
+
+def test_rate_limit():
+    limiter = limits.Limiter("rate", rate=20, burst=5)
+
+    start_time = time.time()
+    for _ in range(15):
+        with limiter:
+            pass
+    elapsed = time.time() - start_time
+
+    # the burst is free, the other 10 take 1/rate each
+    assert 0.45 < elapsed < 1.0
+
+
+def test_concurrency_cap(tmp_path):
+    for lock_dir in [None, str(tmp_path)]:
+        limiter = limits.Limiter("cap", max_concurrent=2, lock_dir=lock_dir)
+        active = list()
+        max_active = list()
+        lock = threading.Lock()
+
+        def work():
+            with limiter:
+                with lock:
+                    active.append(1)
+                    max_active.append(len(active))
+                time.sleep(0.05)
+                with lock:
+                    active.pop()
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+
+        assert max(max_active) == 2
+
+
+def take_tokens(lock_dir: str, num_tokens: int) -> None:
+    limiter = limits.Limiter("shared", rate=20, burst=1, lock_dir=lock_dir)
+    for _ in range(num_tokens):
+        limiter.acquire()
+
+
+def test_shared_rate_limit(tmp_path):
+    """Processes sharing a lock_dir share a single token bucket."""
+    processes = [
+        multiprocessing.Process(target=take_tokens, args=(str(tmp_path), 5))
+        for _ in range(2)
+    ]
+
+    start_time = time.time()
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    elapsed = time.time() - start_time
+
+    assert elapsed > 0.4
+
+
+def test_get_limiter():
+    assert limits.get_limiter("shared_name", rate=1) is limits.get_limiter(
+        "shared_name"
+    )
+
+
+def test_get_limiter_mismatch():
+    unlimited = limits.get_limiter("late_limits")
+    limiter = limits.get_limiter("late_limits", rate=2)
+
+    assert limiter is not unlimited and limiter.rate == 2
+    assert limits.get_limiter("late_limits") is limiter
+
+    with pytest.raises(ValueError):
+        limits.get_limiter("late_limits", rate=5)
+
+
+def test_poll_rate_limit(localurl):
+    """A poll without limits doesn't disable a later poll's limits."""
+    tool_name = "pytest_limited"
+    q = ag.parse_queue(localurl, tool_name)
+    utils.clear_queue(q.url, q.name)
+
+    def poll(**kwargs):
+        ag.insert_tasks(localurl, tool_name, [[i] for i in range(5)], [{}] * 5)
+        start_time = time.time()
+        ag.poll(
+            localurl,
+            tool_name,
+            lambda i: lambda: None,
+            init_waiting_period=0.01,
+            max_waiting_period=0.01,
+            max_num_retries=1,
+            **kwargs,
+        )
+        return time.time() - start_time
+
+    poll()
+    elapsed = poll(rate_limit=10, rate_burst=1)
+
+    # the burst is free, the other 4 take 1/rate each
+    assert elapsed > 0.35
@@ -0,0 +1,86 @@
+"""Tests for kombuworker/memo.py"""
+import time
+
+import numpy as np
+
+from kombuworker import memo
+
+
+def test_memoize_by_keys():
+    calls = list()
+
+    @memo.memoize(["path"], maxsize=2)
+    def setup(path, mode="r"):
+        calls.append(path)
+        return f"{path}:{mode}"
+
+    assert setup(path="a", chunk=1) == "a:r"
+    assert setup(path="a", chunk=2) == "a:r"
+    assert calls == ["a"]
+
+    setup(path="b")
+    setup(path="c")  # evicts "a"
+    setup(path="a")
+    assert calls == ["a", "b", "c", "a"]
+    assert setup.cache.hits == 1
+
+
+def test_ttl():
+    cache = memo.LRUCache(ttl=0.05)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_max_bytes():
+    cache = memo.LRUCache(maxsize=None, max_bytes=10, sizeof=len)
+    cache.put("a", "x" * 6)
+    cache.put("b", "x" * 4)
+    assert len(cache) == 2
+
+    cache.put("c", "x" * 4)  # evicts "a"
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+
+    cache.put("d", "x" * 11)  # too large to cache
+    assert cache.get("d") is None
+
+
+def test_memoize_by_binary():
+    calls = list()
+
+    @memo.memoize(["arr"])
+    def setup(arr=None):
+        calls.append(arr)
+        return len(calls)
+
+    a = np.zeros(2000)
+    b = a.copy()
+    b[1000] = 1  # the same repr as a
+
+    assert setup(arr=a) == 1
+    assert setup(arr=b) == 2
+    assert setup(arr=a.copy()) == 1
+    assert setup(arr=memoryview(b"xy")) == 3
+    assert setup(arr=b"xy") == 3
+
+
+def test_memoize_missing_and_unkeyable():
+    calls = list()
+
+    @memo.memoize(["x"])
+    def setup(x="default"):
+        calls.append(x)
+        return x
+
+    assert setup() == "default"
+    assert setup(x=None) is None
+    assert calls == ["default", None]
+
+    # not cached
+    setup(x=object())
+    setup(x=object())
+    assert len(calls) == 4
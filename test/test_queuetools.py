@@ -5,6 +5,7 @@ import time
 import signal
 import threading
 
+import pytest
 from kombu import Connection
 from kombuworker import queuetools as qt
 import utils
@@ -97,6 +98,188 @@ def test_num_msgs_sqs(SQSurl):
     utils.clear_queue(SQSurl, QUEUENAME)
 
 
+def test_insert_fetch_local(localurl):
+    utils.clear_queue(localurl, QUEUENAME)
+
+    payloads = [f"task{i}" for i in range(11)]
+    qt.insert_msgs(localurl, QUEUENAME, payloads)
+    assert qt.num_msgs(localurl, QUEUENAME) == len(payloads)
+
+    fetched = list()
+    for msg in qt.fetch_msgs(
+        localurl,
+        QUEUENAME,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+    ):
+        fetched.append(msg.payload)
+        qt.ack_msg(msg)
+
+    assert sorted(fetched) == sorted(payloads)
+    assert qt.num_msgs(localurl, QUEUENAME) == 0
+
+
+def test_fetch_batched_acks_local(localurl):
+    utils.clear_queue(localurl, QUEUENAME)
+
+    payloads = [f"task{i}" for i in range(11)]
+    qt.insert_msgs(localurl, QUEUENAME, payloads)
+
+    num_fetched = 0
+    for msg in qt.fetch_msgs(
+        localurl,
+        QUEUENAME,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        ack_batch_size=4,
+    ):
+        qt.ack_msg(msg)
+        num_fetched += 1
+
+    assert num_fetched == len(payloads)
+    # the last partial batch is flushed on shutdown
+    assert qt.num_msgs(localurl, QUEUENAME) == 0
+
+
+def test_ack_msgs_rabbitmq(rabbitMQurl):
+    utils.clear_queue(rabbitMQurl, QUEUENAME)
+
+    payloads = ["test"] * 5
+    qt.insert_msgs(rabbitMQurl, QUEUENAME, payloads)
+
+    with Connection(rabbitMQurl) as conn:
+        queue = conn.SimpleQueue(QUEUENAME)
+        msgs = [queue.get_nowait() for _ in payloads]
+
+        qt.ack_msgs(conn, msgs)
+
+        # one ack (of the last message) covers the batch
+        assert msgs[-1].acknowledged
+        time.sleep(5)
+
+        assert qt.num_msgs_rabbitmq(rabbitMQurl, QUEUENAME) == 0
+
+
+def test_ack_msgs_sqs_mixed_queues(SQSurl):
+    """Batches that mix queues (e.g., stolen shards) delete from each queue."""
+    other = f"{QUEUENAME}_other"
+    qt.insert_msgs(SQSurl, QUEUENAME, ["test"] * 3)
+    qt.insert_msgs(SQSurl, other, ["test"] * 3)
+
+    with Connection(SQSurl) as conn:
+        msgs = list()
+        for queue_name in [QUEUENAME, other]:
+            queue = conn.SimpleQueue(queue_name)
+            msgs.extend(queue.get(timeout=5) for _ in range(3))
+
+        qt.ack_msgs(conn, msgs)
+
+    assert qt.num_msgs_sqs(SQSurl, QUEUENAME) == 0
+    assert qt.num_msgs_sqs(SQSurl, other) == 0
+
+
+def test_delayed_insert_local(localurl):
+    utils.clear_queue(localurl, QUEUENAME)
+
+    start_time = time.time()
+    qt.insert_msgs(localurl, QUEUENAME, ["late"], delay=0.5)
+    qt.insert_msgs(localurl, QUEUENAME, ["early"])
+
+    fetched = list()
+    for msg in qt.fetch_msgs(
+        localurl,
+        QUEUENAME,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        max_num_retries=20,
+    ):
+        fetched.append((msg.payload, time.time() - start_time))
+        qt.ack_msg(msg)
+        if len(fetched) == 2:
+            break
+
+    assert [payload for (payload, _) in fetched] == ["early", "late"]
+    assert fetched[1][1] >= 0.5
+
+
+def test_wait_for_delayed(localurl):
+    if localurl.startswith("sqlite://"):
+        pytest.skip("SQLite queues delay messages themselves")
+    utils.clear_queue(localurl, QUEUENAME)
+
+    qt.insert_msgs(localurl, QUEUENAME, ["late"], delay=0.2, dedup_ids=["a"])
+
+    assert qt.wait_for_delayed(timeout=5)
+    assert utils.count_msgs(localurl, QUEUENAME) == 1
+
+
+def test_delayed_insert_fifo():
+    with pytest.raises(ValueError):
+        qt.insert_msgs("sqs://localhost:9324", "queue.fifo", ["test"], delay=1)
+
+
+def test_delayed_insert_rabbitmq(rabbitMQurl):
+    utils.clear_queue(rabbitMQurl, QUEUENAME)
+
+    qt.insert_msgs(rabbitMQurl, QUEUENAME, ["test"] * 3, delay=2)
+    assert utils.count_msgs(rabbitMQurl, QUEUENAME) == 0
+
+    time.sleep(3)
+    assert utils.count_msgs(rabbitMQurl, QUEUENAME) == 3
+
+
+def test_purge_local(localurl):
+    qt.insert_msgs(localurl, QUEUENAME, ["task"] * 5)
+    qt.purge_queue(localurl, QUEUENAME)
+
+    assert qt.num_msgs(localurl, QUEUENAME) == 0
+
+
+def test_filesystem_folders(tmp_path):
+    """Queues with the same name in different folders are independent."""
+    for folder in ["a", "b"]:
+        url = f"filesystem://{tmp_path}/{folder}"
+        qt.insert_msgs(url, QUEUENAME, ["task"] * 3)
+
+        assert qt.num_msgs(url, QUEUENAME) == 3
+
+
+def test_redelivery_local(localurl):
+    """Un-acked messages are redelivered once their connection closes."""
+    utils.clear_queue(localurl, QUEUENAME)
+    qt.insert_msgs(localurl, QUEUENAME, ["task"])
+
+    with qt.connect(localurl) as conn:
+        conn.SimpleQueue(QUEUENAME).get_nowait()
+
+    assert utils.count_msgs(localurl, QUEUENAME) == 1
+
+
+def test_num_msgs_sqlite(tmp_path):
+    url = f"sqlite://{tmp_path}/queue.db"
+    payloads = ["test"] * 10
+    qt.insert_msgs(url, QUEUENAME, payloads)
+
+    with qt.connect(url) as conn:
+        queue = conn.SimpleQueue(QUEUENAME)
+        msg = queue.get_nowait()
+
+        assert queue.qsize() == len(payloads) - 1
+
+        # can we see "not visible" messages?
+        assert qt.num_msgs_sqlite(url, QUEUENAME) == len(payloads)
+
+        msg.ack()
+
+        assert qt.num_msgs_sqlite(url, QUEUENAME) == len(payloads) - 1
+
+        # un-acked messages are restored when the connection closes
+        queue.get_nowait()
+
+    assert qt.num_msgs_sqlite(url, QUEUENAME) == len(payloads) - 1
+    assert utils.count_msgs(url, QUEUENAME) == len(payloads) - 1
+
+
 def stub_test_indefinite(rabbitMQurl):
     """Killing an indefinite fetching generator.
 
@@ -132,3 +315,51 @@ def stub_test_indefinite(rabbitMQurl):
     )
 
     signal.signal(signal.SIGINT, prev_handler)
+
+
+def test_consumer_receive_local(localurl):
+    utils.clear_queue(localurl, QUEUENAME)
+    qt.insert_msgs(localurl, QUEUENAME, ["a", "b"])
+
+    consumer = qt.Consumer(localurl, QUEUENAME, init_waiting_period=0.01, prefetch=2)
+    with pytest.raises(RuntimeError):
+        consumer.receive(timeout=0)
+
+    with consumer:
+        received = [next(iter(consumer)), consumer.receive(timeout=5)]
+        assert consumer.receive(timeout=0.1) is None
+
+        assert sorted(msg.payload for msg in received) == ["a", "b"]
+        for msg in received:
+            consumer.ack(msg)
+
+    assert qt.num_msgs(localurl, QUEUENAME) == 0
+
+
+def test_parallel_consumers_local(localurl):
+    """Consumers of different queues within one process stay independent."""
+    queue_names = [f"{QUEUENAME}{i}" for i in range(3)]
+    num_payloads = 5
+    for queue_name in queue_names:
+        utils.clear_queue(localurl, queue_name)
+        qt.insert_msgs(localurl, queue_name, [queue_name] * num_payloads)
+
+    received = {queue_name: list() for queue_name in queue_names}
+
+    def consume(queue_name):
+        with qt.Consumer(
+            localurl, queue_name, init_waiting_period=0.01, max_waiting_period=0.1
+        ) as consumer:
+            for msg in consumer:
+                received[queue_name].append(msg.payload)
+                consumer.ack(msg)
+
+    threads = [threading.Thread(target=consume, args=(q,)) for q in queue_names]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    for queue_name in queue_names:
+        assert received[queue_name] == [queue_name] * num_payloads
+        assert qt.num_msgs(localurl, queue_name) == 0
@@ -0,0 +1,95 @@
+"""Tests for kombuworker/recycling.py"""
+import os
+import time
+
+from kombuworker import agnostic as ag
+from kombuworker import recycling
+import utils
+
+
+def touch_parser(path):
+    def fn():
+        open(path, "w").close()
+
+    return fn
+
+
+def test_policy():
+    policy = recycling.RecyclePolicy(max_tasks=2)
+    assert policy.task_done() is None
+    assert policy.task_done() is not None
+
+    policy = recycling.RecyclePolicy(max_rss_mb=1)
+    assert "RSS" in policy.task_done()
+
+    policy = recycling.RecyclePolicy(max_wall_time=0.05)
+    assert policy.task_done() is None
+    time.sleep(0.1)
+    assert policy.task_done() is not None
+
+    assert recycling.rss_bytes() > 2**20
+
+
+def test_poll_max_tasks(localurl, tmp_path):
+    tool_name = "pytest_recycling"
+    utils.clear_queue(localurl, tool_name)
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    for i in range(5):
+        ag.insert_task(localurl, tool_name, str(output_dir / f"{i}"))
+
+    reason = ag.poll(
+        localurl,
+        tool_name,
+        touch_parser,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        max_tasks=2,
+    )
+
+    assert reason is not None
+    assert len(os.listdir(output_dir)) == 2
+    assert utils.count_msgs(localurl, ag.parse_queue(localurl, tool_name).name) == 3
+
+
+def test_supervise(tmp_path):
+    queue_url = f"sqlite://{tmp_path / 'queue.db'}"
+    tool_name = "pytest_supervise"
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    for i in range(6):
+        ag.insert_task(queue_url, tool_name, str(output_dir / f"{i}"))
+
+    recycling.supervise(
+        ag.poll,
+        2,
+        queue_url,
+        tool_name,
+        touch_parser,
+        check_interval=0.1,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        max_num_retries=1,
+        max_tasks=1,
+    )
+
+    assert len(os.listdir(output_dir)) == 6
+
+
+def test_poll_idle_wall_time(localurl):
+    tool_name = "pytest_recycling_idle"
+    utils.clear_queue(localurl, ag.parse_queue(localurl, tool_name).name)
+
+    start_time = time.time()
+    reason = ag.poll(
+        localurl,
+        tool_name,
+        touch_parser,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        max_num_retries=None,
+        max_wall_time=0.3,
+    )
+
+    assert reason is not None
+    assert time.time() - start_time < 5
@@ -1,8 +1,11 @@
 """Tests for kombuworker/taskqueueworker.py"""
 import os
+import signal
 from functools import partial
+import pytest
 from taskqueue import queueable
 
+from kombuworker import dedup
 from kombuworker import taskqueueworker as tqw
 from kombuworker import queuetools as qt
 import utils
@@ -24,6 +27,11 @@ def dummy_side_effect(i):
         f.write(str(i))
 
 
+@queueable
+def failing_task():
+    raise RuntimeError("boom")
+
+
 def test_insert_tasks(rabbitMQurl):
     utils.clear_queue(rabbitMQurl, QUEUENAME)
 
@@ -75,3 +83,81 @@ def test_poll_side_effects(rabbitMQurl):
         os.remove(filename)
 
     os.rmdir(DUMMYDIR)
+
+
+def test_fetch_tasks_local(localurl):
+    utils.clear_queue(localurl, QUEUENAME)
+
+    ids = set(range(10))
+    tqw.insert_tasks(localurl, QUEUENAME, [partial(dummy_task, i) for i in ids])
+
+    results = set()
+    for task, msg in tqw.fetch_tasks(
+        localurl,
+        QUEUENAME,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+    ):
+        results.add(task())
+        qt.ack_msg(msg)
+
+    assert results == ids
+
+
+def test_insert_tasks_dedup(localurl, tmp_path):
+    utils.clear_queue(localurl, QUEUENAME)
+    index = dedup.Index(str(tmp_path / "dedup.db"))
+
+    tqw.insert_tasks(localurl, QUEUENAME, [partial(dummy_task, 1)], dedup_index=index)
+    tqw.insert_tasks(
+        localurl,
+        QUEUENAME,
+        [partial(dummy_task, 1), partial(dummy_task, 2)],
+        dedup_index=index,
+    )
+
+    tqw.poll(
+        localurl,
+        QUEUENAME,
+        init_waiting_period=0.01,
+        max_waiting_period=0.1,
+        dedup_index=index,
+    )
+
+    assert utils.count_msgs(localurl, QUEUENAME) == 0
+    assert len(index) == 0
+
+
+def test_insert_tasks_dedup_failure(tmp_path):
+    index = dedup.Index(str(tmp_path / "dedup.db"))
+
+    # SQS can't delay messages this long, so nothing is published
+    with pytest.raises(ValueError):
+        tqw.insert_tasks(
+            "sqs://localhost:9324",
+            QUEUENAME,
+            [partial(dummy_task, 1)],
+            delay=10**6,
+            dedup_index=index,
+        )
+
+    assert len(index) == 0
+
+
+def test_poll_failure_cleans_up(localurl, tmp_path):
+    utils.clear_queue(localurl, QUEUENAME)
+    tqw.insert_tasks(localurl, QUEUENAME, [partial(failing_task)])
+    path = str(tmp_path / "worker.sock")
+    prev_handler = signal.getsignal(signal.SIGINT)
+
+    with pytest.raises(RuntimeError):
+        tqw.poll(
+            localurl,
+            QUEUENAME,
+            introspect_address=path,
+            capture_path=str(tmp_path / "capture"),
+        )
+
+    assert not os.path.exists(path)
+    assert signal.getsignal(signal.SIGINT) is prev_handler
+    assert utils.count_msgs(localurl, QUEUENAME) == 1
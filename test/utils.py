@@ -2,7 +2,6 @@
 import time
 
 import requests
-from kombu import Connection
 
 from kombuworker import queuetools as qt
 
@@ -12,7 +11,7 @@ def count_msgs(queue_url: str, queue_name: str) -> int:
 
     Also empties the queue.
     """
-    with Connection(queue_url) as conn:
+    with qt.connect(queue_url) as conn:
         queue = conn.SimpleQueue(queue_name)
 
         size = queue.qsize()